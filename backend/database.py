@@ -30,8 +30,19 @@ else:
 # Build SQLAlchemy URL
 DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Connection pool tuning: DB_POOL_SIZE / DB_MAX_OVERFLOW / DB_POOL_RECYCLE override
+# SQLAlchemy's defaults only when set in the environment
+def _pool_kwargs():
+    env_names = {"pool_size": "DB_POOL_SIZE", "max_overflow": "DB_MAX_OVERFLOW", "pool_recycle": "DB_POOL_RECYCLE"}
+    return {kwarg: int(os.getenv(name)) for kwarg, name in env_names.items() if os.getenv(name)}
+
 # SQLAlchemy Init
-engine = create_engine(DATABASE_URL, echo=False, pool_pre_ping=True)
+engine = create_engine(
+    DATABASE_URL,
+    echo=False,
+    pool_pre_ping=True,
+    **_pool_kwargs(),
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -5,7 +5,7 @@ Optimized Wix sync (Option C, final) - MERGED (Option A1 name/address extraction
 - Robust invoice logic (delivery distribution, subtotal).
 - Proper payment and totals determination.
 - Duplicate detection, force=1 item recreation.
-- Per-order commit/rollback and predictable logging.
+- Per-order savepoint/rollback, one commit per SYNC_BATCH_SIZE batch and predictable logging.
 - Drop into routes/ and wire router as before.
 """
 
@@ -13,14 +13,24 @@ import os
 import re
 import json
 import asyncio
+import collections
 import logging
 from datetime import datetime
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Callable
 
+import functools
+import itertools
 import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from fastapi import APIRouter, Depends, HTTPException, Request
-from sqlalchemy import text
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import text, bindparam
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import Session
 
 from dotenv import load_dotenv
@@ -28,14 +38,47 @@ load_dotenv()
 
 from database import SessionLocal
 
+try:
+    import orjson
+except Exception:  # optional: faster JSON parsing of Wix pages and encoding of reconcile reports
+    orjson = None
+
 # Router
 router = APIRouter(prefix="/sync", tags=["Wix Sync"])
 
 # Config
 WIX_API_KEY = os.getenv("WIX_API_KEY")
 WIX_SITE_ID = os.getenv("WIX_SITE_ID")
+WIX_CREDENTIALS_OK = bool(WIX_API_KEY and WIX_SITE_ID)
+# Built once; every Wix API call reuses it
+_WIX_HEADERS = {"Authorization": WIX_API_KEY, "wix-site-id": WIX_SITE_ID, "Content-Type": "application/json"}
+
+# One pooled keep-alive session for every blocking Wix call (TLS handshake paid once).
+# Wix query/get endpoints are read-only POSTs, so retrying them is safe.
+_WIX = requests.Session()
+_WIX.headers.update(_WIX_HEADERS)
+_WIX.mount("https://", HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(429, 502, 503, 504),
+                      allowed_methods=frozenset({"GET", "POST"}), raise_on_status=False),
+))
 DEFAULT_CATEGORY_ID = int(os.getenv("DEFAULT_AUTO_CATEGORY_ID", 26))
 MIN_VALID_SKU_LEN = 2
+WIX_PAGE_SIZE = 100
+SYNC_BATCH_SIZE = 20  # orders written + committed per transaction
+
+# Precompiled patterns used in the per-order / per-line-item paths
+_NON_DIGIT_RE = re.compile(r"\D")
+_BAD_SKU_RE = re.compile(r"^(unknown|misc|test)$", re.I)
+_PRICE_CLEAN_RE = re.compile(r"[^\d.\-]")
+_WORD_RE = re.compile(r"[A-Za-z0-9]+")
+# str.translate deletion table: every ASCII character except 0-9
+_NON_DIGIT_DELETE = str.maketrans("", "", "".join(chr(c) for c in range(128) if not "0" <= chr(c) <= "9"))
+
+# Upper-cased Wix payment / gateway statuses that mean the order is paid
+_PAID_STATUSES = frozenset(("PAID", "ACCEPTED", "SUCCESS"))
+_GATEWAY_PAID_STATUSES = frozenset(("SUCCESS", "PAID", "CAPTURED"))
 
 # Logging
 logger = logging.getLogger("wix_sync")
@@ -44,7 +87,8 @@ if not logger.handlers:
     fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s")
     h.setFormatter(fmt)
     logger.addHandler(h)
-logger.setLevel(logging.DEBUG)
+# WIX_SYNC_LOG_LEVEL=DEBUG also logs full line_items payloads per order
+logger.setLevel(os.getenv("WIX_SYNC_LOG_LEVEL", "INFO").upper())
 
 # ---------------------------
 # FIX 3: Background auto-sync every 5 minutes
@@ -69,6 +113,9 @@ def _run_background_sync():
                         return default
 
             result = sync_wix_orders(request=_FakeRequest(), db=db)
+            if result.get("status") == "already_running":
+                logger.info("[AutoSync] Previous Wix sync still running, skipping this run")
+                return
             logger.info(
                 "[AutoSync] Done — inserted=%s skipped=%s",
                 result.get("inserted"), result.get("skipped")
@@ -95,6 +142,9 @@ def start_wix_auto_sync():
     with _sync_lock:
         if _sync_timer is not None:
             return  # already running
+        if not WIX_CREDENTIALS_OK:
+            logger.error("[AutoSync] WIX_API_KEY / WIX_SITE_ID not set — background Wix sync disabled")
+            return
         logger.info("[AutoSync] Scheduling first Wix sync in %ds", WIX_SYNC_INTERVAL_SECONDS)
         _sync_timer = threading.Timer(WIX_SYNC_INTERVAL_SECONDS, _run_background_sync)
         _sync_timer.daemon = True
@@ -166,9 +216,31 @@ def safe_str(v: Optional[Any]) -> str:
         return ""
     return str(v)
 
+def _json_body(res) -> Any:
+    """Decode a Wix response body (requests or httpx), straight from bytes with orjson when installed."""
+    if orjson is not None:
+        return orjson.loads(res.content)
+    return res.json()
+
+def _dig(d: Any, *keys: str) -> Any:
+    """d[k1][k2]... for nested Wix payloads; None as soon as a level is missing or not a dict."""
+    for k in keys:
+        if not isinstance(d, dict):
+            return None
+        d = d.get(k)
+        if d is None:
+            return None
+    return d
+
+def _digits(value: str) -> str:
+    """Strip everything but digits. ASCII input (the usual case) goes through str.translate."""
+    if value.isascii():
+        return value.translate(_NON_DIGIT_DELETE)
+    return _NON_DIGIT_RE.sub("", value)
+
 def normalize_mobile_10(value: Optional[Any]) -> str:
     """Normalize Wix/contact numbers to the local 10-digit mobile stored in DB."""
-    digits = re.sub(r"\D", "", safe_str(value)).lstrip("0")
+    digits = _digits(safe_str(value)).lstrip("0")
     if digits.startswith("91") and len(digits) > 10:
         digits = digits[-10:]
     elif len(digits) > 10:
@@ -183,142 +255,381 @@ def _notify_orders_table_changed(order_id: str, action: str = "changed") -> None
     except Exception as exc:
         logger.debug("Order websocket notify skipped for %s: %s", order_id, exc)
 
-def sanitize_scalar(value: Any):
-    if value is None:
-        return ""
-    if isinstance(value, (str, int, float, bool, datetime)):
-        return value
-    try:
-        return json.dumps(value, ensure_ascii=False)
-    except Exception:
-        return str(value)
-
 def is_valid_sku(sku: Optional[str]) -> bool:
     if not sku:
         return False
     s = str(sku).strip()
     if len(s) < MIN_VALID_SKU_LEN:
         return False
-    return not re.match(r'^(unknown|misc|test)$', s, re.I)
+    return not _BAD_SKU_RE.match(s)
 
 # ---------------------------
 # Synthetic mobile generator
 # ---------------------------
-def generate_synthetic_mobile(db: Session) -> str:
-    try:
-        r = db.execute(text("""
-            SELECT COALESCE(MAX(CAST(mobile AS UNSIGNED)), 0) FROM offline_customer
-            WHERE mobile REGEXP '^[0-9]+$'
-        """)).first()
-        mx = int(r[0]) if r and r[0] is not None else 0
-    except Exception:
-        mx = 0
+_MAX_NUMERIC_OFFLINE_MOBILE = text("""
+    SELECT COALESCE(MAX(CAST(mobile AS UNSIGNED)), 0) FROM offline_customer
+    WHERE mobile REGEXP '^[0-9]+$'
+""")
+
+def generate_synthetic_mobile(db: Session, counters: Optional[Dict[str, Optional[int]]] = None) -> str:
+    """
+    Next unused numeric mobile for offline customers without a phone. With `counters`,
+    the MAX() scan runs once and later calls just increment counters["synthetic_mobile"].
+    """
+    mx = counters.get("synthetic_mobile") if counters is not None else None
+    if mx is None:
+        try:
+            r = db.execute(_MAX_NUMERIC_OFFLINE_MOBILE).first()
+            mx = int(r[0]) if r and r[0] is not None else 0
+        except Exception:
+            mx = 0
+    if counters is not None:
+        counters["synthetic_mobile"] = mx + 1
     return str(mx + 1).zfill(10)
 
 # ---------------------------
 # Product helpers
 # ---------------------------
+# Statements are built once at import and reused on every call
+_FIND_PRODUCT_BY_SKU = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku, '') AS zoho_sku
+    FROM products WHERE sku_id = :s LIMIT 1
+""")
+_FIND_PRODUCT_BY_WIX_PID = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku
+    FROM products
+    WHERE sku_id = :w OR product_id = :w
+    LIMIT 1
+""")
+_FIND_PRODUCT_BY_NAME = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku
+    FROM products
+    WHERE LOWER(name) = :n LIMIT 1
+""")
+_FIND_PRODUCT_BY_NAME_LIKE = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku
+    FROM products
+    WHERE LOWER(name) LIKE :n LIMIT 1
+""")
+
 def find_product_by_sku(db: Session, sku: str) -> Optional[Dict]:
     if not sku:
         return None
-    r = db.execute(text("""
-        SELECT product_id, name, sku_id, IFNULL(zoho_sku, '') AS zoho_sku
-        FROM products WHERE sku_id = :s LIMIT 1
-    """), {"s": sku}).first()
+    r = db.execute(_FIND_PRODUCT_BY_SKU, {"s": sku}).first()
     return dict(r._mapping) if r else None
 
 def find_product_by_wix_pid(db: Session, wix_pid: str) -> Optional[Dict]:
     if not wix_pid:
         return None
-    r = db.execute(text("""
-        SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku
-        FROM products
-        WHERE sku_id = :w OR product_id = :w
-        LIMIT 1
-    """), {"w": wix_pid}).first()
+    r = db.execute(_FIND_PRODUCT_BY_WIX_PID, {"w": wix_pid}).first()
     return dict(r._mapping) if r else None
 
 def find_product_by_name(db: Session, name: str) -> Optional[Dict]:
     if not name:
         return None
-    r = db.execute(text("""
-        SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku
-        FROM products
-        WHERE LOWER(name) = :n LIMIT 1
-    """), {"n": name.lower()}).first()
+    r = db.execute(_FIND_PRODUCT_BY_NAME, {"n": name.lower()}).first()
     if r:
         return dict(r._mapping)
-    r2 = db.execute(text("""
-        SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku
-        FROM products
-        WHERE LOWER(name) LIKE :n LIMIT 1
-    """), {"n": f"%{name.lower()}%"}).first()
+    r2 = db.execute(_FIND_PRODUCT_BY_NAME_LIKE, {"n": f"%{name.lower()}%"}).first()
     return dict(r2._mapping) if r2 else None
 
-def create_product_fallback(db: Session, sku: Optional[str], title: str):
-    now = datetime.utcnow()
+def _resolve_product(db: Session, cache: Dict, sku: str, wix_pid: str, title: str):
+    """
+    Resolve a line item to a product: SKU first, then Wix product id, then name.
+    Lookups (including misses) are memoized in `cache`, keyed by (kind, key), for the
+    duration of one request. Returns (product, mapping) or (None, None).
+    """
+    def _lookup(kind: str, key: str, finder):
+        ck = (kind, key)
+        if ck not in cache:
+            cache[ck] = finder(db, key)
+        return cache[ck]
+
+    # Try SKU first
+    if is_valid_sku(sku):
+        product = _lookup("sku", sku, find_product_by_sku)
+        if product:
+            return product, f"sku:{sku}"
+        logger.debug("SKU %r not found in products table", sku)
+
+    # Try wix product id
+    if wix_pid:
+        product = _lookup("wixpid", wix_pid, find_product_by_wix_pid)
+        if product:
+            return product, f"wixpid:{wix_pid}"
+        logger.debug("wix_pid %r not found in products table", wix_pid)
+
+    # Try product name
+    if title:
+        product = _lookup("name", title, find_product_by_name)
+        if product:
+            return product, f"name:{title}"
+        logger.debug("title %r not found in products table", title)
+
+    return None, None
+
+_FIND_PRODUCTS_BY_SKUS = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku, '') AS zoho_sku
+    FROM products WHERE sku_id IN :skus
+""").bindparams(bindparam("skus", expanding=True))
+_FIND_PRODUCTS_BY_WIX_PIDS = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku, '') AS zoho_sku
+    FROM products WHERE sku_id IN :w OR product_id IN :w
+""").bindparams(bindparam("w", expanding=True))
+_FIND_PRODUCTS_BY_NAMES = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku, '') AS zoho_sku
+    FROM products WHERE LOWER(name) IN :names
+""").bindparams(bindparam("names", expanding=True))
+
+def _line_item_sku(li: Dict) -> str:
+    # FIX 1: Broaden SKU extraction - check all common Wix SKU fields
+    phys = li.get("physicalProperties") or {}
+    sku_raw = (
+        phys.get("sku")
+        or li.get("sku")
+        or li.get("variantSku")
+        or li.get("skuId")
+        or (li.get("catalogReference") or {}).get("catalogItemId")
+        or ""
+    )
+    return safe_str(sku_raw).strip()
+
+def _line_item_wix_pid(li: Dict) -> str:
+    return safe_str(
+        (li.get("catalogReference") or {}).get("catalogItemId")
+        if isinstance(li.get("catalogReference"), dict)
+        else li.get("productId") or li.get("product_id") or ""
+    )
+
+def _line_item_title(li: Dict) -> str:
+    name_field = li.get("productName") or li.get("name") or li.get("title") or ""
+    return safe_str(name_field.get("original") if isinstance(name_field, dict) else name_field)
+
+def preload_products(db: Session, cache: Dict, wix_orders: List[Dict]):
+    """
+    Fill the `_resolve_product` cache for every line item in `wix_orders` with at most
+    three IN queries (SKU, then Wix product id, then exact name), so the line-item loop
+    does dict lookups instead of up to three SELECTs per item. Each stage only asks
+    about items the previous one left unresolved. The misc fallback product rides
+    along with the SKU query.
+
+    SKU and Wix product id misses are cached as misses; name misses are left out so
+    `find_product_by_name` can still try its LIKE fallback for them.
+    """
+    items = [
+        (_line_item_sku(li), _line_item_wix_pid(li), _line_item_title(li))
+        for w in wix_orders
+        for li in (w.get("lineItems") or w.get("items") or [])
+        if isinstance(li, dict)
+    ]
+    if not items:
+        return
+
+    # sku_id uses a case-insensitive collation, so match rows back case-insensitively
+    skus = {sku for sku, _, _ in items if is_valid_sku(sku) and ("sku", sku) not in cache}
+    if _MISC_PRODUCT is None and ("sku", "misc") not in cache:
+        skus.add("misc")
+    if skus:
+        found: Dict[str, Dict] = {}
+        for r in db.execute(_FIND_PRODUCTS_BY_SKUS, {"skus": list(skus)}).fetchall():
+            found.setdefault(str(r.sku_id).lower(), dict(r._mapping))
+        for sku in skus:
+            cache[("sku", sku)] = found.get(sku.lower())
+
+    def _unresolved(sku: str) -> bool:
+        return not (is_valid_sku(sku) and cache.get(("sku", sku)))
+
+    pids = {pid for sku, pid, _ in items if pid and _unresolved(sku) and ("wixpid", pid) not in cache}
+    if pids:
+        found = {}
+        for r in db.execute(_FIND_PRODUCTS_BY_WIX_PIDS, {"w": list(pids)}).fetchall():
+            row = dict(r._mapping)
+            found.setdefault(str(r.sku_id).lower(), row)
+            found.setdefault(str(r.product_id), row)
+        for pid in pids:
+            cache[("wixpid", pid)] = found.get(pid.lower()) or found.get(pid)
+
+    titles = {
+        title for sku, pid, title in items
+        if title and _unresolved(sku) and not (pid and cache.get(("wixpid", pid))) and ("name", title) not in cache
+    }
+    if titles:
+        found = {}
+        for r in db.execute(_FIND_PRODUCTS_BY_NAMES, {"names": list({t.lower() for t in titles})}).fetchall():
+            found.setdefault(str(r.name).lower(), dict(r._mapping))
+        for title in titles:
+            if title.lower() in found:
+                cache[("name", title)] = found[title.lower()]
+
+# Fallback products never change once created, so they are kept for the life of the
+# process. Only hits are cached: a missing product is looked up again next time.
+_MISC_PRODUCT: Optional[Dict] = None
+_UNKNOWN_PRODUCT: Optional[Dict] = None
+
+def _misc_product(db: Session, cache: Dict) -> Optional[Dict]:
+    """Catch-all product (sku_id='misc') for unmatched line items, looked up once per process."""
+    global _MISC_PRODUCT
+    if _MISC_PRODUCT is None:
+        ck = ("sku", "misc")
+        if ck not in cache:
+            cache[ck] = find_product_by_sku(db, "misc")
+        _MISC_PRODUCT = cache[ck]
+    return _MISC_PRODUCT
+
+_INSERT_FALLBACK_PRODUCT = text("""
+    INSERT INTO products (name, description, category_id, product_type, created_at, sku_id)
+    VALUES (:name, :desc, :cat, 'auto', :created_at, :sku)
+""")
+_FIND_PRODUCT_BY_EXACT_NAME = text("""
+    SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku
+    FROM products WHERE name = :n LIMIT 1
+""")
+_INSERT_UNKNOWN_PRODUCT = text("""
+    INSERT INTO products (name, description, category_id, product_type, created_at)
+    VALUES (:name, :desc, :cat, 'auto', :created_at)
+""")
+
+def create_product_fallback(db: Session, sku: Optional[str], title: str, now: Optional[datetime] = None):
+    now = now or datetime.utcnow()
     name = f"{title} ({sku})" if sku else title
-    db.execute(text("""
-        INSERT INTO products (name, description, category_id, product_type, created_at, sku_id)
-        VALUES (:name, :desc, :cat, 'auto', :created_at, :sku)
-    """), {"name": sanitize_scalar(name), "desc": "Auto-created from Wix", "cat": DEFAULT_CATEGORY_ID, "created_at": now, "sku": sku})
-    pid = db.execute(text("SELECT LAST_INSERT_ID()")).scalar()
-    r = db.execute(text("SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku FROM products WHERE product_id = :pid LIMIT 1"), {"pid": pid}).first()
-    return dict(r._mapping) if r else {"product_id": pid, "name": name, "sku_id": sku or ""}
-
-def ensure_unknown_product(db: Session) -> Dict:
-    r = db.execute(text("SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') as zoho_sku FROM products WHERE name = :n LIMIT 1"), {"n": "Unknown Product (auto)"}).first()
+    result = db.execute(_INSERT_FALLBACK_PRODUCT, {"name": name, "desc": "Auto-created from Wix", "cat": DEFAULT_CATEGORY_ID, "created_at": now, "sku": sku})
+    # Build the row from what we just inserted instead of re-reading it.
+    return {"product_id": result.lastrowid, "name": name, "sku_id": sku or "", "zoho_sku": ""}
+
+def ensure_unknown_product(db: Session, now: Optional[datetime] = None) -> Dict:
+    global _UNKNOWN_PRODUCT
+    if _UNKNOWN_PRODUCT is not None:
+        return _UNKNOWN_PRODUCT
+    r = db.execute(_FIND_PRODUCT_BY_EXACT_NAME, {"n": "Unknown Product (auto)"}).first()
     if r:
-        return dict(r._mapping)
-    db.execute(text("""
-        INSERT INTO products (name, description, category_id, product_type, created_at)
-        VALUES (:name, :desc, :cat, 'auto', :created_at)
-    """), {"name": "Unknown Product (auto)", "desc": "Fallback product", "cat": DEFAULT_CATEGORY_ID, "created_at": datetime.utcnow()})
-    pid = db.execute(text("SELECT LAST_INSERT_ID()")).scalar()
-    r2 = db.execute(text("SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') as zoho_sku FROM products WHERE product_id = :pid LIMIT 1"), {"pid": pid}).first()
-    return dict(r2._mapping) if r2 else {"product_id": pid, "name": "Unknown Product (auto)", "sku_id": ""}
+        # Only a committed row is cached; a fresh insert below may still be rolled back
+        _UNKNOWN_PRODUCT = dict(r._mapping)
+        return _UNKNOWN_PRODUCT
+    result = db.execute(_INSERT_UNKNOWN_PRODUCT, {"name": "Unknown Product (auto)", "desc": "Fallback product", "cat": DEFAULT_CATEGORY_ID, "created_at": now or datetime.utcnow()})
+    return {"product_id": result.lastrowid, "name": "Unknown Product (auto)", "sku_id": "", "zoho_sku": ""}
 
 # ---------------------------
 # Customer helpers (CREATES if missing)
 # ---------------------------
-def find_customer(db: Session, mobile=None, email=None):
+_FIND_CUSTOMER_BY_MOBILE = text("SELECT customer_id, name, mobile, email FROM customer WHERE mobile = :m LIMIT 1")
+_FIND_CUSTOMER_BY_EMAIL = text("SELECT customer_id, name, mobile, email FROM customer WHERE email = :e LIMIT 1")
+_INSERT_CUSTOMER = text("INSERT INTO customer (name, mobile, email) VALUES (:name, :mobile, :email)")
+_FIND_OFFLINE_CUSTOMER_BY_MOBILE = text("SELECT customer_id, name, mobile, email FROM offline_customer WHERE mobile = :m LIMIT 1")
+_INSERT_OFFLINE_CUSTOMER = text("INSERT INTO offline_customer (name, mobile, email) VALUES (:name, :mobile, :email)")
+
+_FIND_CUSTOMERS_BY_MOBILES = text(
+    "SELECT customer_id, name, mobile, email FROM customer WHERE mobile IN :m"
+).bindparams(bindparam("m", expanding=True))
+_FIND_CUSTOMERS_BY_EMAILS = text(
+    "SELECT customer_id, name, mobile, email FROM customer WHERE email IN :e"
+).bindparams(bindparam("e", expanding=True))
+
+def find_customer(db: Session, mobile=None, email=None, cache: Optional[Dict] = None):
+    """
+    Customer by mobile, then by email. With `cache` (filled by preload_customers),
+    keys already looked up are answered without a query.
+    """
     if mobile:
-        r = db.execute(text("SELECT customer_id, name, mobile, email FROM customer WHERE mobile = :m LIMIT 1"), {"m": mobile}).first()
-        if r: return dict(r._mapping)
+        ck = ("mobile", mobile)
+        if cache is not None and ck in cache:
+            r = cache[ck]
+        else:
+            r = db.execute(_FIND_CUSTOMER_BY_MOBILE, {"m": mobile}).first()
+            r = dict(r._mapping) if r else None
+        if r: return r
     if email:
-        r = db.execute(text("SELECT customer_id, name, mobile, email FROM customer WHERE email = :e LIMIT 1"), {"e": email}).first()
-        if r: return dict(r._mapping)
+        ck = ("email", email)
+        if cache is not None and ck in cache:
+            r = cache[ck]
+        else:
+            r = db.execute(_FIND_CUSTOMER_BY_EMAIL, {"e": email}).first()
+            r = dict(r._mapping) if r else None
+        if r: return r
     return None
 
+def preload_customers(db: Session, cache: Dict, mobiles, emails):
+    """
+    Look up all customers for a batch with one IN query per dimension (mobile, email)
+    and cache them, keyed by ("mobile", m) / ("email", e). Mobile misses are cached too.
+    """
+    mobiles = [m for m in set(mobiles) if m and ("mobile", m) not in cache]
+    if mobiles:
+        found: Dict[str, Dict] = {}
+        for r in db.execute(_FIND_CUSTOMERS_BY_MOBILES, {"m": mobiles}).fetchall():
+            found.setdefault(str(r.mobile), dict(r._mapping))
+        for m in mobiles:
+            cache[("mobile", m)] = found.get(m)
+
+    # What `email = :e` matches depends on the column's collation, so only rows whose
+    # email is exactly the requested string are cached; any other email (including a
+    # miss) is left to find_customer's own query, which the DB compares as before.
+    emails = [e for e in set(emails) if e and ("email", e) not in cache]
+    if emails:
+        found = {}
+        for r in db.execute(_FIND_CUSTOMERS_BY_EMAILS, {"e": emails}).fetchall():
+            found.setdefault(str(r.email), dict(r._mapping))
+        for e in emails:
+            if e in found:
+                cache[("email", e)] = found[e]
+
+def remember_customer(cache, customer_id, name, mobile, email):
+    """
+    Record a resolved/created customer so later orders in the sync reuse it. Blank
+    fields of an already cached row are filled the way upsert_customer fills the table.
+    Cached rows are replaced, never changed in place, so a caller can stage writes in
+    a per-batch layer (ChainMap) and drop them if the batch rolls back.
+    """
+    keys = []
+    if mobile:
+        keys.append(("mobile", mobile))
+    if email:
+        keys.append(("email", email))
+    prev = next((cache[k] for k in keys if cache.get(k) and cache[k]["customer_id"] == customer_id), None)
+    row = dict(prev or {"customer_id": customer_id, "name": None, "mobile": None, "email": None})
+    for field, value in (("name", name), ("mobile", mobile), ("email", email)):
+        if value and not row.get(field):
+            row[field] = value
+    for k in keys:
+        # only under the value the row actually holds, as `mobile = :m` / `email = :e` would find it
+        if row.get(k[0]) != k[1]:
+            continue
+        cur = cache.get(k)
+        if not cur or cur["customer_id"] == customer_id:
+            cache[k] = row
+
 def create_customer(db: Session, name: str, mobile: str, email: str):
     try:
-        db.execute(text("INSERT INTO customer (name, mobile, email) VALUES (:name, :mobile, :email)"),
-                   {"name": sanitize_scalar(name), "mobile": sanitize_scalar(mobile or ""), "email": sanitize_scalar(email or "")})
-        cid = db.execute(text("SELECT LAST_INSERT_ID()")).scalar()
-        return cid
+        result = db.execute(_INSERT_CUSTOMER,
+                            {"name": name or "", "mobile": mobile or "", "email": email or ""})
+        return result.lastrowid
     except Exception as e:
         logger.exception("create_customer failed: %s", e)
         # fallback: try to find again
         return find_customer(db, mobile=mobile, email=email)
 
-def upsert_customer(db: Session, name, mobile, email):
+@functools.lru_cache(maxsize=8)
+def _update_customer_stmt(cols: tuple):
+    """UPDATE customer for a fixed set of columns, built once. Names come from code, never from input."""
+    return text(f"UPDATE customer SET {', '.join(f'{c} = :{c}' for c in cols)} WHERE customer_id = :cid")
+
+def upsert_customer(db: Session, name, mobile, email, cache: Optional[Dict] = None):
     """
     Ensure a customer row exists in `customer`. If present, attempt to fill missing name/mobile/email.
     If not present, create it. Returns customer_id or None.
     """
-    existing = find_customer(db, mobile, email)
+    existing = find_customer(db, mobile, email, cache)
     if existing:
         updates = {}
         if name and not existing.get("name"):
-            updates["name"] = sanitize_scalar(name)
+            updates["name"] = name
         if mobile and not existing.get("mobile"):
-            updates["mobile"] = sanitize_scalar(mobile)
+            updates["mobile"] = mobile
         if email and not existing.get("email"):
-            updates["email"] = sanitize_scalar(email)
+            updates["email"] = email
         if updates:
-            updates["cid"] = existing["customer_id"]
-            set_sql = ", ".join([f"{k} = :{k}" for k in updates if k != "cid"])
-            db.execute(text(f"UPDATE customer SET {set_sql} WHERE customer_id = :cid"), updates)
+            # cached rows are left alone here; the caller records the filled row via
+            # remember_customer once the write is known to have committed
+            db.execute(_update_customer_stmt(tuple(updates)), {**updates, "cid": existing["customer_id"]})
         return existing["customer_id"]
     # not existing -> create
     try:
@@ -331,10 +642,11 @@ def upsert_customer(db: Session, name, mobile, email):
 def find_offline_customer_by_mobile(db: Session, mobile: str):
     if not mobile:
         return None
-    r = db.execute(text("SELECT customer_id, name, mobile, email FROM offline_customer WHERE mobile = :m LIMIT 1"), {"m": mobile}).first()
+    r = db.execute(_FIND_OFFLINE_CUSTOMER_BY_MOBILE, {"m": mobile}).first()
     return dict(r._mapping) if r else None
 
-def create_or_get_offline_customer(db: Session, name=None, mobile=None, email=None):
+def create_or_get_offline_customer(db: Session, name=None, mobile=None, email=None,
+                                   counters: Optional[Dict[str, Optional[int]]] = None):
     if mobile and len(str(mobile).strip()) < 7:
         mobile = None
     if mobile:
@@ -344,17 +656,16 @@ def create_or_get_offline_customer(db: Session, name=None, mobile=None, email=No
     use_mobile = mobile or None
     if not use_mobile:
         for _ in range(5):
-            cand = generate_synthetic_mobile(db)
+            cand = generate_synthetic_mobile(db, counters)
             if not find_offline_customer_by_mobile(db, cand):
                 use_mobile = cand
                 break
         if not use_mobile:
             use_mobile = datetime.utcnow().strftime("000%y%m%d%H%M%S")[:15]
     try:
-        db.execute(text("INSERT INTO offline_customer (name, mobile, email) VALUES (:name, :mobile, :email)"),
-                   {"name": sanitize_scalar(name) or "", "mobile": use_mobile, "email": sanitize_scalar(email)})
-        cid = db.execute(text("SELECT LAST_INSERT_ID()")).scalar()
-        return cid
+        result = db.execute(_INSERT_OFFLINE_CUSTOMER,
+                            {"name": name or "", "mobile": use_mobile, "email": email or ""})
+        return result.lastrowid
     except Exception:
         existing = find_offline_customer_by_mobile(db, use_mobile)
         if existing:
@@ -364,20 +675,8 @@ def create_or_get_offline_customer(db: Session, name=None, mobile=None, email=No
 # ---------------------------
 # Address helpers
 # ---------------------------
-def find_state_id(db: Session, state_text: Optional[str]):
-    if not state_text:
-        return None
-
-    s = state_text.strip().lower()
-
-    # Handle Wix "IN-BR", "IN-UP", etc.
-    if "-" in s:
-        parts = s.split("-", 1)
-        if len(parts) == 2:
-            s = parts[1]  # BR, UP, MH
-
-    # Map short codes properly
-    abbrev = {
+# Map short codes properly
+_STATE_ABBREV = {
     # States
     "ap": "andhra pradesh",
     "ar": "arunachal pradesh",
@@ -421,112 +720,235 @@ def find_state_id(db: Session, state_text: Optional[str]):
     "py": "puducherry"
 }
 
-    if s in abbrev:
-        s = abbrev[s]
+def _normalize_state_text(state_text: str) -> str:
+    s = state_text.strip().lower()
+
+    # Handle Wix "IN-BR", "IN-UP", etc.
+    if "-" in s:
+        parts = s.split("-", 1)
+        if len(parts) == 2:
+            s = parts[1]  # BR, UP, MH
+
+    return _STATE_ABBREV.get(s, s)
+
+_STATE_MAP: Optional[Dict[str, int]] = None
+
+def load_state_map(db: Session, refresh: bool = False) -> Dict[str, int]:
+    """
+    Load the (small, read-only) state table as {lower(name): state_id}.
+    Cached for the life of the process; pass refresh=True to reload.
+    """
+    global _STATE_MAP
+    if _STATE_MAP is None or refresh:
+        rows = db.execute(text("SELECT state_id, name FROM state")).fetchall()
+        _STATE_MAP = {safe_str(r[1]).strip().lower(): int(r[0]) for r in rows if r[1]}
+        _match_cached_state.cache_clear()
+    return _STATE_MAP
+
+def _match_state(s: str, state_map: Dict[str, int]) -> Optional[int]:
+    if s in state_map:
+        return state_map[s]
+    # Partial match only if input is longer (avoid AP → Andhra)
+    if len(s) > 2:
+        for state_name, state_id in state_map.items():
+            if s in state_name:
+                return state_id
+    return None
+
+@functools.lru_cache(maxsize=512)
+def _match_cached_state(state_text: str) -> Optional[int]:
+    """Subdivision string -> state_id against the process-wide state map."""
+    return _match_state(_normalize_state_text(state_text), _STATE_MAP or {})
+
+_FIND_STATE_EXACT = text("SELECT state_id FROM state WHERE LOWER(name)=:n LIMIT 1")
+_FIND_STATE_LIKE = text("SELECT state_id FROM state WHERE LOWER(name) LIKE :n LIMIT 1")
+
+def find_state_id(db: Session, state_text: Optional[str], state_map: Optional[Dict[str, int]] = None):
+    if not state_text:
+        return None
+
+    # Preloaded lookup table: no DB traffic (memoized per subdivision string)
+    if state_map is not None:
+        if state_map is _STATE_MAP:
+            return _match_cached_state(state_text)
+        return _match_state(_normalize_state_text(state_text), state_map)
+
+    s = _normalize_state_text(state_text)
 
     # Exact match
-    r = db.execute(text("SELECT state_id FROM state WHERE LOWER(name)=:n LIMIT 1"), {"n": s}).first()
+    r = db.execute(_FIND_STATE_EXACT, {"n": s}).first()
     if r:
         return int(r[0])
 
     # Partial match only if input is longer (avoid AP → Andhra)
     if len(s) > 2:
-        r2 = db.execute(text("SELECT state_id FROM state WHERE LOWER(name) LIKE :n LIMIT 1"),
-                        {"n": f"%{s}%"}).first()
+        r2 = db.execute(_FIND_STATE_LIKE, {"n": f"%{s}%"}).first()
         return int(r2[0]) if r2 else None
 
     return None
 
+_ADDRESS_HASH_CHECKED = False
+_ADDRESS_HASH_READY = False
+
+def detect_address_hash_column(db: Session) -> bool:
+    """
+    Check once per process whether the optional `address.address_hash` lookup column
+    (see "Required indexes" above _INSERT_ORDER) exists. Read-only: the column is a
+    one-time migration, never added from the request path. Without it the lookup
+    falls back to a plain exact address_line match.
+    """
+    global _ADDRESS_HASH_CHECKED, _ADDRESS_HASH_READY
+    if _ADDRESS_HASH_CHECKED:
+        return _ADDRESS_HASH_READY
+    try:
+        _ADDRESS_HASH_READY = bool(db.execute(text("SHOW COLUMNS FROM address LIKE 'address_hash'")).fetchone())
+    except Exception as exc:
+        logger.debug("Could not inspect address.address_hash: %s", exc)
+        _ADDRESS_HASH_READY = False
+    if not _ADDRESS_HASH_READY:
+        logger.info("address.address_hash not present, using exact address_line match")
+    _ADDRESS_HASH_CHECKED = True
+    return _ADDRESS_HASH_READY
+
+@functools.lru_cache(maxsize=2)
+def _find_address_stmt(hash_ready: bool):
+    # MySQL computes the probe hash itself, so it always matches the generated column
+    addr_match = "address_hash = MD5(LOWER(TRIM(:addr)))" if hash_ready else "address_line = :addr"
+    return text(f"""
+        SELECT * FROM address
+        WHERE {addr_match}
+          AND (mobile = :mob OR :mob = '')
+          AND (pincode = :pin OR :pin = '')
+          AND (city = :cty OR :cty = '')
+        LIMIT 1
+    """)
+
+@functools.lru_cache(maxsize=32)
+def _insert_stmt(table: str, cols: tuple):
+    """INSERT for a fixed (table, columns) shape, built once. Names come from code, never from input."""
+    return text(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(':' + c for c in cols)})")
+
 def find_existing_address(db: Session, address_line: str, mobile: str, pincode: str, city: str):
     addr = (address_line or "").strip()
     mob = (mobile or "").strip()
     pin = (pincode or "").strip()
     cty = (city or "").strip()
     try:
-        r = db.execute(text("""
-            SELECT * FROM address
-            WHERE (address_line = :addr OR address_line LIKE :addr_like)
-              AND (mobile = :mob OR :mob = '')
-              AND (pincode = :pin OR :pin = '')
-              AND (city = :cty OR :cty = '')
-            LIMIT 1
-        """), {"addr": addr, "addr_like": f"%{addr}%", "mob": mob, "pin": pin, "cty": cty}).first()
+        r = db.execute(_find_address_stmt(_ADDRESS_HASH_READY),
+                       {"addr": addr, "mob": mob, "pin": pin, "cty": cty}).first()
         return dict(r._mapping) if r else None
     except Exception as e:
         logger.exception("find_existing_address error: %s", e)
         return None
 
-def create_address(db: Session, payload: Dict):
+def create_address(db: Session, payload: Dict, now: Optional[datetime] = None):
+    now = now or datetime.utcnow()
     defaults = {
         "locality": "", "address_line": "", "city": "", "state_id": 1,
-        "address_type": "shipping", "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(), "is_available": 1
+        "address_type": "shipping", "created_at": now,
+        "updated_at": now, "is_available": 1
     }
     for k, v in defaults.items():
         if k not in payload or payload[k] is None:
             payload[k] = v
-    cols = ", ".join(payload.keys())
-    vals = ", ".join([f":{c}" for c in payload.keys()])
-    db.execute(text(f"INSERT INTO address ({cols}) VALUES ({vals})"), payload)
-    return db.execute(text("SELECT LAST_INSERT_ID()")).scalar()
+    result = db.execute(_insert_stmt("address", tuple(payload)), payload)
+    return result.lastrowid
 
 # ---------------------------
 # Order Details helper (LEGACY REQUIRED)
 # ---------------------------
-def insert_order_details(db: Session, order_id: str, item_id: int, product_id: int):
+_INSERT_ORDER_ITEM = text("""
+    INSERT INTO order_items (order_id, product_id, model_id, color_id,
+                             quantity, unit_price, total_price)
+    VALUES (:oid, :pid, NULL, NULL, :qty, :unit, :total)
+""")
+_INSERT_ORDER_DETAILS_FOR_ORDERS = text("""
+    INSERT INTO order_details (item_id, order_id, product_id, sr_no)
+    SELECT oi.item_id, oi.order_id, oi.product_id, NULL
+    FROM order_items oi
+    WHERE oi.order_id IN :ids
+      AND NOT EXISTS (SELECT 1 FROM order_details od WHERE od.item_id = oi.item_id)
+""").bindparams(bindparam("ids", expanding=True))
+
+def insert_order_details_for_orders(db: Session, order_ids: List[str]):
     """
-    Ensures legacy compatibility.
+    Ensures legacy compatibility: mirror every order_items row of `order_ids` that has
+    no order_details row yet, in one INSERT ... SELECT.
     Must be called AFTER inserting into order_items.
     """
-    db.execute(text("""
-        INSERT INTO order_details
-            (item_id, order_id, product_id, sr_no)
-        VALUES
-            (:item_id, :order_id, :product_id, NULL)
-    """), {
-        "item_id": item_id,
-        "order_id": order_id,
-        "product_id": product_id
-    })
+    if order_ids:
+        db.execute(_INSERT_ORDER_DETAILS_FOR_ORDERS, {"ids": list(order_ids)})
 
 
 # ---------------------------
 # Utilities
 # ---------------------------
+EXISTING_IDS_CHUNK = 1000
+_FIND_EXISTING_ORDER_IDS = text(
+    "SELECT order_id FROM orders WHERE order_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+
+def find_existing_order_ids(db: Session, raw_ids: List[str]) -> set:
+    """
+    Return the subset of order ids already present in `orders`, checked with one IN
+    query per EXISTING_IDS_CHUNK candidates. Both the WIX#<number> form and legacy
+    un-prefixed ids are matched.
+    """
+    candidates = set()
+    for raw_id in raw_ids:
+        if raw_id:
+            candidates.add(raw_id)
+            candidates.add(f"WIX#{raw_id}")
+    candidates = list(candidates)
+    found = set()
+    for start in range(0, len(candidates), EXISTING_IDS_CHUNK):
+        rows = db.execute(_FIND_EXISTING_ORDER_IDS, {"ids": candidates[start:start + EXISTING_IDS_CHUNK]}).fetchall()
+        found.update(str(r[0]) for r in rows)
+    return found
+
+_MAX_ORDER_INDEX = text("SELECT MAX(order_index) FROM orders")
+
 def get_next_order_index(db: Session) -> int:
-    r = db.execute(text("SELECT MAX(order_index) FROM orders")).first()
+    r = db.execute(_MAX_ORDER_INDEX).first()
     mx = int(r[0]) if r and r[0] is not None else None
     if not mx:
         return int(datetime.utcnow().timestamp())
     return int(mx) + 1
 
-def extract_price_value(li: Dict) -> float:
-    candidates = [
-        lambda x: (x.get("price") or {}).get("amount") if isinstance(x.get("price"), dict) else x.get("price"),
-        lambda x: (x.get("lineItemPrice") or {}).get("amount"),
-        lambda x: (x.get("totalPriceAfterTax") or {}).get("amount"),
-        lambda x: x.get("price"),
-        lambda x: x.get("unitPrice"),
-        lambda x: x.get("sellingPrice"),
-        lambda x: x.get("total"),
-    ]
-    for fn in candidates:
+def _price_amount(v: Any):
+    return v.get("amount") if isinstance(v, dict) else None
+
+def _price_to_float(v: Any) -> Optional[float]:
+    """Parse a Wix price value; None when it cannot be read as a number."""
+    if isinstance(v, dict) and "amount" in v:
+        v = v.get("amount")
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        s = _PRICE_CLEAN_RE.sub("", str(v))
         try:
-            v = fn(li)
-        except Exception:
-            v = None
+            return float(s) if s else 0.0
+        except ValueError:
+            return None
+
+def extract_price_value(li: Dict) -> float:
+    # First candidate that parses wins: price(.amount), lineItemPrice.amount,
+    # totalPriceAfterTax.amount, unitPrice, sellingPrice, total
+    price = li.get("price")
+    candidates = (
+        price.get("amount") if isinstance(price, dict) else price,
+        _price_amount(li.get("lineItemPrice")),
+        _price_amount(li.get("totalPriceAfterTax")),
+        li.get("unitPrice"),
+        li.get("sellingPrice"),
+        li.get("total"),
+    )
+    for v in candidates:
         if v is None:
             continue
-        if isinstance(v, dict) and "amount" in v:
-            v = v.get("amount")
-        try:
-            return float(v)
-        except Exception:
-            try:
-                s = re.sub(r'[^\d.\-]', '', str(v))
-                return float(s) if s else 0.0
-            except Exception:
-                continue
+        f = _price_to_float(v)
+        if f is not None:
+            return f
     return 0.0
 
 def invoice_description_for_product(product: Optional[Dict]) -> str:
@@ -538,32 +960,105 @@ def invoice_description_for_product(product: Optional[Dict]) -> str:
     name = (product.get("name") or "").lower()
     if "gps" in name: return "GPS"
     if "scanner" in name: return "Scanner"
-    words = re.findall(r"[A-Za-z0-9]+", product.get("name") or "")
+    words = _WORD_RE.findall(product.get("name") or "")
     return " ".join(words[:2]) if words else "Item"
 
 # ---------------------------
 # Wix helpers
 # ---------------------------
-def fetch_wix_order_number(order_id: str):
-    if not order_id:
-        return None
+async def _fetch_wix_order_number_async(client: httpx.AsyncClient, order_id: str):
     try:
-        res = requests.post(
+        res = await client.post(
             "https://www.wixapis.com/stores/v2/orders/get",
-            headers={"Authorization": WIX_API_KEY, "wix-site-id": WIX_SITE_ID, "Content-Type": "application/json"},
+            headers=_WIX_HEADERS,
             json={"id": order_id},
-            timeout=20
         )
         if res.status_code != 200:
-            logger.warning("fetch_wix_order_number failed for %s: %s", order_id, res.text[:200])
+            logger.warning("fetch_wix_order_numbers failed for %s: %s", order_id, res.text[:200])
             return None
-        data = res.json()
-        # Wix returns order object under "order"
-        return data.get("order", {}).get("number")
+        return _json_body(res).get("order", {}).get("number")
     except Exception as e:
-        logger.exception("fetch_wix_order_number error: %s", e)
+        logger.exception("fetch_wix_order_numbers error: %s", e)
         return None
 
+def fetch_wix_order_numbers(order_ids: List[str]) -> Dict[str, Any]:
+    """
+    Fetch order numbers for several Wix order ids concurrently over one pooled client.
+    Returns {order_id: number or None}. Must be called from a sync (non-event-loop) thread.
+    """
+    ids = list(dict.fromkeys(i for i in order_ids if i))
+    if not ids:
+        return {}
+
+    async def _gather():
+        limits = httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        async with httpx.AsyncClient(timeout=20, limits=limits) as client:
+            numbers = await asyncio.gather(*(_fetch_wix_order_number_async(client, oid) for oid in ids))
+        return dict(zip(ids, numbers))
+
+    return asyncio.run(_gather())
+
+WIX_ORDERS_QUERY_URL = "https://www.wixapis.com/stores/v2/orders/query"
+
+def _wix_query_page_body(offset: int, limit: int) -> Dict:
+    # Stores v2 query: offset paging inside "query"; responses carry totalResults
+    return {"query": {"paging": {"limit": limit, "offset": offset}}}
+
+def _query_wix_page(offset: int, limit: int, **kwargs):
+    """One page of the Stores v2 orders query. Every caller pages this same way."""
+    return _WIX.post(WIX_ORDERS_QUERY_URL, json=_wix_query_page_body(offset, limit), timeout=30, **kwargs)
+
+def iter_wix_orders(max_pages: Optional[int] = 1, page_size: int = WIX_PAGE_SIZE):
+    """
+    Yield Wix orders one at a time, fetching pages lazily via offset paging.
+    The next page is requested on a helper thread while the caller is still
+    writing the current one, so Wix latency overlaps with DB work.
+    Paging stops after `max_pages`, on a short page, or once totalResults is reached.
+    A failure on the first page raises HTTPException; a failure on a later page
+    stops the iteration so already-processed orders are kept.
+    """
+    page = 0
+    offset = 0
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(_query_wix_page, offset, page_size)
+        while pending is not None:
+            try:
+                res = pending.result()
+            except Exception as e:
+                logger.exception("Failed to call Wix API: %s", e)
+                if page == 0:
+                    raise HTTPException(status_code=500, detail=f"Wix API error: {e}")
+                return
+
+            if res.status_code != 200:
+                logger.error("Wix API returned non-200: %s - %s", res.status_code, res.text[:300])
+                if page == 0:
+                    raise HTTPException(status_code=500, detail=f"Wix responded: {res.status_code}")
+                return
+
+            data = _json_body(res)
+            orders = data.get("orders", []) or []
+            logger.debug("Fetched %d orders from Wix (page %d)", len(orders), page + 1)
+
+            page += 1
+            offset += page_size
+            total = data.get("totalResults")
+            # start the next request before handing this page out
+            pending = None
+            if (len(orders) >= page_size
+                    and (total is None or offset < int(total))
+                    and (max_pages is None or page < max_pages)):
+                pending = pool.submit(_query_wix_page, offset, page_size)
+            yield from orders
+
+def _batched(iterable, size: int):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
 # ---------------------------
 # Helpers: robust fullName normalization (Option A1)
 # ---------------------------
@@ -593,54 +1088,281 @@ def normalize_fullname(val: Any) -> str:
         return ""
 
 # ---------------------------
-# Main sync endpoint (final optimized)
+# Order write statements (orders rows per order, order_items once per batch)
 # ---------------------------
-@router.get("/wix")
-def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
+# All sync/reconcile statements are module-level text() objects, so SQLAlchemy
+# compiles each once per process and reuses it from the engine's compiled cache.
+#
+# Required indexes (run once in MySQL — idempotent):
+#   orders.order_id is the primary key — the reconcile/duplicate lookups use it directly.
+#   CREATE INDEX IF NOT EXISTS idx_oi_order          ON order_items (order_id);
+#   CREATE INDEX IF NOT EXISTS idx_od_item           ON order_details (item_id);
+#   CREATE INDEX IF NOT EXISTS idx_products_sku      ON products (sku_id);
+#   CREATE INDEX IF NOT EXISTS idx_cust_mobile       ON customer (mobile);
+#   CREATE INDEX IF NOT EXISTS idx_off_cust_mobile   ON offline_customer (mobile);
+#
+#   Optional, for indexed address reuse (detect_address_hash_column picks it up on the
+#   next process start). VIRTUAL, so InnoDB adds and indexes it in place without a
+#   table copy:
+#   ALTER TABLE address
+#     ADD COLUMN address_hash CHAR(32) GENERATED ALWAYS AS (MD5(LOWER(TRIM(address_line)))) VIRTUAL,
+#     ADD INDEX idx_addr_hash (address_hash, mobile, pincode);
+_INSERT_ORDER = text("""
+    INSERT INTO orders
+    (order_id, customer_id, offline_customer_id, address_id,
+     total_items, subtotal, total_amount, channel, payment_status,
+     delivery_status, created_at, updated_at, order_index, payment_type, gst, upload_wbn,
+     discount_percent, delivery_charge, tax_percent, fulfillment_status,
+     delivery_method, order_status)
+    VALUES
+    (:order_id, :customer_id, :offline_customer_id, :address_id,
+     :total_items, :subtotal, :total_amount, :channel, :payment_status,
+     :delivery_status, :created_at, :updated_at, :order_index, :payment_type, :gst, :upload_wbn,
+     :discount_percent, :delivery_charge, :tax_percent, :fulfillment_status,
+     :delivery_method, :order_status)
+""")
+_UPDATE_ORDER = text("""
+    UPDATE orders SET
+      total_items = :total_items,
+      subtotal = :subtotal,
+      total_amount = :total_amount,
+      payment_status = :payment_status,
+      updated_at = :updated_at,
+      discount_percent = :discount_percent,
+      delivery_charge = :delivery_charge,
+      tax_percent = :tax_percent,
+      fulfillment_status = :fulfillment_status,
+      delivery_method = :delivery_method,
+      order_status = :order_status
+    WHERE order_id = :order_id
+""")
+
+def _insert_order_row(db: Session, order_payload: Dict) -> int:
     """
-    Sync Wix orders (single page). Use ?force=1 to force reprocessing (recreate order_items).
+    INSERT the orders row and return the order_index it was stored with.
+    Orders created outside the sync (manual/AI orders) can take an index handed out
+    from this batch's seed; on that duplicate the index is re-read from MAX() and the
+    INSERT retried once.
     """
-    force = request.query_params.get("force") == "1"
-
-    if not WIX_API_KEY or not WIX_SITE_ID:
-        logger.error("Missing Wix credentials")
-        raise HTTPException(status_code=500, detail="Missing Wix credentials")
-
-    # fetch a single page (limit 100)
+    sp = db.begin_nested()
     try:
-        res = requests.post(
-            "https://www.wixapis.com/stores/v2/orders/query",
-            headers={"Authorization": WIX_API_KEY, "wix-site-id": WIX_SITE_ID, "Content-Type": "application/json"},
-            json={"paging": {"limit": 100}},
-            timeout=30
-        )
+        db.execute(_INSERT_ORDER, order_payload)
+        sp.commit()
+        return order_payload["order_index"]
+    except IntegrityError as e:
+        sp.rollback()
+        logger.warning("Order %s: INSERT failed (%s), retrying with a fresh order_index", order_payload["order_id"], e.orig)
+    order_payload["order_index"] = get_next_order_index(db)
+    db.execute(_INSERT_ORDER, order_payload)
+    return order_payload["order_index"]
+
+_DELETE_ORDER_ITEMS_FOR_ORDERS = text(
+    "DELETE FROM order_items WHERE order_id IN :ids"
+).bindparams(bindparam("ids", expanding=True))
+_SELECT_NOW = text("SELECT NOW()")
+
+def _execute_many_isolated(db: Session, stmt, rows: List[Dict], key: str) -> Dict[Any, str]:
+    """
+    Execute `stmt` for all `rows` in one executemany inside a SAVEPOINT. If the batch
+    fails, retry row by row (each in its own SAVEPOINT) so one bad row does not sink
+    the rest. Returns {row[key]: error} for the rows that could not be written.
+    """
+    if not rows:
+        return {}
+    sp = db.begin_nested()
+    try:
+        db.execute(stmt, rows)
+        sp.commit()
+        return {}
     except Exception as e:
-        logger.exception("Failed to call Wix API: %s", e)
-        raise HTTPException(status_code=500, detail=f"Wix API error: {e}")
+        sp.rollback()
+        logger.warning("Bulk write of %d rows failed, retrying individually: %s", len(rows), e)
 
-    if res.status_code != 200:
-        logger.error("Wix API returned non-200: %s - %s", res.status_code, res.text[:300])
-        raise HTTPException(status_code=500, detail=f"Wix responded: {res.status_code}")
+    failed: Dict[Any, str] = {}
+    for row in rows:
+        sp = db.begin_nested()
+        try:
+            db.execute(stmt, row)
+            sp.commit()
+        except Exception as e:
+            sp.rollback()
+            failed[row[key]] = str(e)
+    return failed
+
+_REGION_KEYS = ("subdivision", "subdivisionFullname", "state", "region", "province", "administrativeArea")
+
+def _split_fullname(value: Any, fn: str, ln: str):
+    """Split a Wix fullName into (first, rest); keeps the given fn/ln when it is empty."""
+    full = normalize_fullname(value)
+    if not full:
+        return fn, ln
+    parts = full.split()
+    return (parts[0] if parts else ""), (" ".join(parts[1:]) if len(parts) > 1 else ln)
+
+def _contact_from_address(addr: Dict, contact: Dict) -> Dict:
+    """
+    Contact + address fields from one Wix address / contactDetails pair (shipping or
+    billing), each nested dict walked once.
+    """
+    fn = ""
+    ln = ""
+    if isinstance(contact, dict):
+        fn = contact.get("firstName") or ""
+        ln = contact.get("lastName") or ""
+        # sometimes fullName may exist
+        if not fn and isinstance(contact.get("fullName"), (str, dict)):
+            fn, ln = _split_fullname(contact.get("fullName"), fn, ln)
+    # address may have fullName block
+    if not fn and isinstance(addr, dict) and addr.get("fullName"):
+        fn, ln = _split_fullname(addr.get("fullName"), fn, ln)
+    # last fallback to explicit fields
+    if not fn and isinstance(addr, dict):
+        fn = addr.get("firstName") or ""
+        ln = addr.get("lastName") or ""
+
+    full = f"{fn} {ln}".strip()
+    return {
+        "fullName": full or None,
+        "firstName": fn.strip() or None,
+        "lastName": ln.strip() or None,
+        "phone": contact.get("phone") or addr.get("phone"),
+        "email": addr.get("email") or contact.get("email"),
+        "addressLine1": addr.get("addressLine") or addr.get("addressLine1"),
+        "postalCode": addr.get("postalCode") or addr.get("zipCode"),
+        "city": addr.get("city"),
+        "region": next((v for v in map(addr.get, _REGION_KEYS) if v), None),
+    }
 
-    payload = res.json()
-    wix_orders = payload.get("orders", []) or []
-    logger.debug("Fetched %d orders from Wix", len(wix_orders))
+def _extract_address_info(billing: Dict, shipping: Dict, buyer: Dict) -> Dict:
+    """Robust contact + address extraction (Option A1): shipping, then billing, then buyer."""
+    # shipping destination preferred
+    ship_dest = _dig(shipping, "logistics", "shippingDestination")
+    ship_addr = _dig(ship_dest, "address") or _dig(shipping, "shipmentDetails", "address") or {}
+    ship_contact = _dig(ship_dest, "contactDetails") or _dig(shipping, "shipmentDetails", "contactDetails") or {}
+    if ship_addr or ship_contact:
+        return _contact_from_address(ship_addr, ship_contact)
+
+    # billing fallback
+    bill_addr = billing.get("address") or {}
+    bill_contact = billing.get("contactDetails") or {}
+    if bill_addr or bill_contact:
+        return _contact_from_address(bill_addr, bill_contact)
+
+    # buyer fallback
+    bn_fn = ""
+    bn_ln = ""
+    if isinstance(buyer, dict):
+        bn_fn = buyer.get("firstName") or ""
+        bn_ln = buyer.get("lastName") or ""
+        if not bn_fn and buyer.get("fullName"):
+            bn_fn, bn_ln = _split_fullname(buyer.get("fullName"), bn_fn, bn_ln)
+    full = f"{bn_fn or ''} {bn_ln or ''}".strip()
+    return {
+        "fullName": full or None,
+        "firstName": bn_fn.strip() or None,
+        "lastName": bn_ln.strip() or None,
+        "phone": buyer.get("phone"),
+        "email": buyer.get("email"),
+        "addressLine1": buyer.get("addressLine") or buyer.get("address") or "",
+        "postalCode": "",
+        "city": "",
+        "region": (
+            buyer.get("region")
+            or buyer.get("state")
+            or buyer.get("province")
+        )
+    }
 
+# ---------------------------
+# Batch worker (one transaction per batch)
+# ---------------------------
+def _rollback_order_savepoint(savepoint):
+    """Undo a failed order's writes, leaving the rest of the batch intact."""
+    try:
+        if savepoint is not None and savepoint.is_active:
+            savepoint.rollback()
+    except Exception:
+        logger.exception("Rollback after failed order failed.")
+
+def _sync_wix_batch(
+    db: Session,
+    wix_orders: List[Dict],
+    force: bool,
+    state_map: Optional[Dict[str, int]],
+    address_cache: Dict[tuple, tuple],
+    product_cache: Dict[tuple, Optional[Dict]],
+    counters: Dict[str, Optional[int]],
+    customer_cache: Dict[tuple, Optional[Dict]],
+):
+    """
+    Sync one batch of Wix orders in a single transaction (one SAVEPOINT per order).
+    `counters` holds the last synthetic mobile handed out in this sync run, seeded from
+    its MAX() the first time an order needs one. order_index is seeded per batch.
+    Returns (inserted, skipped, details).
+    """
     inserted = 0
     skipped = 0
     details: List[Dict] = []
 
+    # Determine the wix order number for every order (prefer number; fallback only if missing).
+    # Missing numbers are fetched concurrently before touching the DB.
+    fetched_numbers = fetch_wix_order_numbers([w.get("id") for w in wix_orders if not w.get("number")])
+    raw_ids: List[str] = []
     for w in wix_orders:
+        wix_number = w.get("number") or fetched_numbers.get(w.get("id")) or w.get("id")
+        raw_ids.append(safe_str(wix_number).strip())
+
+    # Duplicate check for the whole batch in one query (matches WIX#number and legacy raw ids)
+    try:
+        existing_ids = find_existing_order_ids(db, raw_ids)
+    except Exception as e:
+        logger.exception("Duplicate check failed: %s", e)
+        raise HTTPException(status_code=500, detail=f"Duplicate check failed: {e}")
+
+    # Resolve every product in the batch up front (a few IN queries instead of several per line item)
+    try:
+        preload_products(db, product_cache, wix_orders)
+    except Exception as e:
+        logger.warning("Product preload failed, falling back to per-item lookups: %s", e)
+
+    # Same for customers: one IN query by mobile and one by email for the whole batch
+    contacts: List[Optional[Dict]] = []
+    for w in wix_orders:
+        try:
+            contacts.append(_extract_address_info(w.get("billingInfo") or {}, w.get("shippingInfo") or {}, w.get("buyerInfo") or {}))
+        except Exception:
+            contacts.append(None)  # re-extracted (and reported) inside the order's try block
+    try:
+        preload_customers(
+            db, customer_cache,
+            (normalize_mobile_10(safe_str(c.get("phone") or "")) for c in contacts if c),
+            (safe_str(c.get("email") or "") for c in contacts if c),
+        )
+    except Exception as e:
+        logger.warning("Customer preload failed, falling back to per-order lookups: %s", e)
+
+    # The whole batch is written in one transaction and committed once after the loop.
+    # Each order runs inside its own SAVEPOINT, which covers its customer, address and
+    # orders row, so a failing order is rolled back alone; order_items follow after the loop.
+    staged: List[Dict] = []
+    batch_order_ids = set()
+    # Addresses resolved by this batch are only shared with later batches once the batch
+    # commits: a failed commit rolls back the rows it created, so their ids must not outlive it.
+    batch_addresses: Dict[tuple, tuple] = {}
+    # Same for customers: created/filled rows land in the first map and reach the
+    # run-level cache only after the commit; lookups see both layers.
+    batch_customers = collections.ChainMap({}, customer_cache)
+    # created_at/updated_at from the DB server clock, read once per batch on first use
+    created_at = None
+    # next order_index to hand out; seeded from MAX() by the batch's first new order
+    next_order_index: Optional[int] = None
+
+    for i, (w, raw_id) in enumerate(zip(wix_orders, raw_ids)):
         # reset per-order DB transaction state if used externally
         order_result = {"wix_order_id": None, "status": None, "reasons": [], "items": []}
+        savepoint = None
 
         try:
-            # 1) Determine the wix order number (prefer number; fallback only if missing)
-            wix_number = w.get("number")
-            if not wix_number:
-                wix_number = fetch_wix_order_number(w.get("id")) or w.get("id")
-
-            raw_id = safe_str(wix_number).strip()
             wix_order_id = f"WIX#{raw_id}" if raw_id else None
             order_result["wix_order_id"] = wix_order_id
 
@@ -651,20 +1373,15 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
                 details.append(order_result)
                 continue
 
-            # Duplicate check (match WIX#number, raw id or previous versions)
-            existing_order_row = db.execute(
-                text("""
-                    SELECT order_id 
-                    FROM orders
-                    WHERE order_id = :oid_raw
-                    OR order_id = CONCAT('WIX#', :noprefix)
-                    OR REPLACE(order_id, 'WIX#', '') = :noprefix
-                    LIMIT 1
-                """),
-                {"oid_raw": wix_order_id, "noprefix": raw_id}
-            ).first()
-
-            existing_order = bool(existing_order_row)
+            if wix_order_id in batch_order_ids:
+                skipped += 1
+                order_result["status"] = "skipped"
+                order_result["reasons"].append("duplicate_in_batch")
+                details.append(order_result)
+                continue
+            batch_order_ids.add(wix_order_id)
+
+            existing_order = wix_order_id in existing_ids or raw_id in existing_ids
 
             if existing_order and not force:
                 skipped += 1
@@ -673,8 +1390,10 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
                 details.append(order_result)
                 continue
 
-            # created_at from DB server
-            created_at = db.execute(text("SELECT NOW()")).scalar()
+            savepoint = db.begin_nested()
+
+            if created_at is None:
+                created_at = db.execute(_SELECT_NOW).scalar()
 
             # ----------------------
             #  CUSTOMER + ADDRESS
@@ -683,140 +1402,7 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
             shipping = w.get("shippingInfo") or {}
             buyer = w.get("buyerInfo") or {}
 
-            # robust extraction (Option A1)
-            def _extract_address_info():
-                # shipping destination preferred
-                ship_dest = (shipping.get("logistics") or {}).get("shippingDestination") or {}
-                ship_addr = ship_dest.get("address") or (shipping.get("shipmentDetails") or {}).get("address") or {}
-                ship_contact = ship_dest.get("contactDetails") or (shipping.get("shipmentDetails") or {}).get("contactDetails") or {}
-
-                # detect presence
-                if ship_addr or ship_contact:
-                    # try multiple sources for name
-                    fn = ""
-                    ln = ""
-                    # shipping contact may be dict
-                    if isinstance(ship_contact, dict):
-                        fn = ship_contact.get("firstName") or ""
-                        ln = ship_contact.get("lastName") or ""
-                        # sometimes fullName may exist
-                        if not fn and isinstance(ship_contact.get("fullName"), (str, dict)):
-                            fn_full = normalize_fullname(ship_contact.get("fullName"))
-                            if fn_full:
-                                parts = fn_full.split()
-                                fn = parts[0] if parts else ""
-                                ln = " ".join(parts[1:]) if len(parts) > 1 else ln
-                    # ship_addr may have fullName block
-                    if (not fn and isinstance(ship_addr, dict)) and ship_addr.get("fullName"):
-                        fn_full = normalize_fullname(ship_addr.get("fullName"))
-                        if fn_full:
-                            parts = fn_full.split()
-                            fn = parts[0] if parts else ""
-                            ln = " ".join(parts[1:]) if len(parts) > 1 else ln
-
-                    # last fallback to explicit fields
-                    if not fn and isinstance(ship_addr, dict):
-                        fn = ship_addr.get("firstName") or ""
-                        ln = ship_addr.get("lastName") or ""
-
-                    full = f"{fn or ''} {ln or ''}".strip()
-
-                    return {
-                        "fullName": full or None,
-                        "firstName": fn.strip() or None,
-                        "lastName": ln.strip() or None,
-                        "phone": ship_contact.get("phone") or ship_addr.get("phone"),
-                        "email": ship_addr.get("email") or ship_contact.get("email"),
-                        "addressLine1": ship_addr.get("addressLine") or ship_addr.get("addressLine1") or ship_addr.get("addressLine"),
-                        "postalCode": ship_addr.get("postalCode") or ship_addr.get("zipCode"),
-                        "city": ship_addr.get("city"),
-                        "region": (
-                            ship_addr.get("subdivision")
-                            or ship_addr.get("subdivisionFullname")
-                            or ship_addr.get("state")
-                            or ship_addr.get("region")
-                            or ship_addr.get("province")
-                            or ship_addr.get("administrativeArea")
-                        )
-                    }
-
-                # billing fallback
-                bill_addr = billing.get("address") or {}
-                bill_contact = billing.get("contactDetails") or {}
-                if bill_addr or bill_contact:
-                    fn = ""
-                    ln = ""
-                    if isinstance(bill_contact, dict):
-                        fn = bill_contact.get("firstName") or ""
-                        ln = bill_contact.get("lastName") or ""
-                        if not fn and isinstance(bill_contact.get("fullName"), (str, dict)):
-                            fn_full = normalize_fullname(bill_contact.get("fullName"))
-                            if fn_full:
-                                parts = fn_full.split()
-                                fn = parts[0] if parts else ""
-                                ln = " ".join(parts[1:]) if len(parts) > 1 else ln
-                    if (not fn and isinstance(bill_addr, dict)) and bill_addr.get("fullName"):
-                        fn_full = normalize_fullname(bill_addr.get("fullName"))
-                        if fn_full:
-                            parts = fn_full.split()
-                            fn = parts[0] if parts else ""
-                            ln = " ".join(parts[1:]) if len(parts) > 1 else ln
-
-                    if not fn and isinstance(bill_addr, dict):
-                        fn = bill_addr.get("firstName") or ""
-                        ln = bill_addr.get("lastName") or ""
-
-                    full = f"{fn or ''} {ln or ''}".strip()
-
-                    return {
-                        "fullName": full or None,
-                        "firstName": fn.strip() or None,
-                        "lastName": ln.strip() or None,
-                        "phone": bill_contact.get("phone") or bill_addr.get("phone"),
-                        "email": bill_addr.get("email") or bill_contact.get("email"),
-                        "addressLine1": bill_addr.get("addressLine") or bill_addr.get("addressLine1") or bill_addr.get("addressLine"),
-                        "postalCode": bill_addr.get("postalCode") or bill_addr.get("zipCode"),
-                        "city": bill_addr.get("city"),
-                        "region": (
-                            bill_addr.get("subdivision")
-                            or bill_addr.get("subdivisionFullname")
-                            or bill_addr.get("state")
-                            or bill_addr.get("region")
-                            or bill_addr.get("province")
-                            or bill_addr.get("administrativeArea")
-                        )
-                    }
-
-                # buyer fallback
-                bn_fn = ""
-                bn_ln = ""
-                if isinstance(buyer, dict):
-                    bn_fn = buyer.get("firstName") or ""
-                    bn_ln = buyer.get("lastName") or ""
-                    if not bn_fn and buyer.get("fullName"):
-                        bn_full = normalize_fullname(buyer.get("fullName"))
-                        if bn_full:
-                            parts = bn_full.split()
-                            bn_fn = parts[0] if parts else ""
-                            bn_ln = " ".join(parts[1:]) if len(parts) > 1 else bn_ln
-                full = f"{bn_fn or ''} {bn_ln or ''}".strip()
-                return {
-                    "fullName": full or None,
-                    "firstName": bn_fn.strip() or None,
-                    "lastName": bn_ln.strip() or None,
-                    "phone": buyer.get("phone"),
-                    "email": buyer.get("email"),
-                    "addressLine1": buyer.get("addressLine") or buyer.get("address") or "",
-                    "postalCode": "",
-                    "city": "",
-                    "region": (
-                        buyer.get("region")
-                        or buyer.get("state")
-                        or buyer.get("province")
-                    )
-                }
-
-            contact = _extract_address_info()
+            contact = contacts[i] if contacts[i] is not None else _extract_address_info(billing, shipping, buyer)
             # Ensure we have a name: prefer fullName then firstName then buyer names
             name_candidate = safe_str(contact.get("fullName") or contact.get("firstName") or (buyer.get("firstName") or buyer.get("lastName")) or "")
             name = name_candidate.strip() or None
@@ -830,35 +1416,40 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
             customer_id = None
             offline_customer_id = None
             try:
-                customer_id = upsert_customer(db, name, phone_digits, email)
+                customer_id = upsert_customer(db, name, phone_digits, email, batch_customers)
                 if not customer_id:
-                    offline_customer_id = create_or_get_offline_customer(db, name, phone_digits, email)
+                    offline_customer_id = create_or_get_offline_customer(db, name, phone_digits, email, counters)
             except Exception as e:
                 logger.exception("customer resolution failed: %s", e)
                 order_result["reasons"].append(f"customer_resolution_failed:{e}")
 
             # address handling: reuse existing or create new
-            addr_line_raw = sanitize_scalar(contact.get("addressLine1") or "")
-            pincode_raw = sanitize_scalar(contact.get("postalCode") or "")
-            city_raw = sanitize_scalar(contact.get("city") or "")
+            addr_line_raw = safe_str(contact.get("addressLine1") or "")
+            pincode_raw = safe_str(contact.get("postalCode") or "")
+            city_raw = safe_str(contact.get("city") or "")
 
             address_id = None
             resolved_state_id = None
+            addr_key = (phone_digits, addr_line_raw, pincode_raw, city_raw)
             try:
-                existing_addr = find_existing_address(db, addr_line_raw, phone_digits, pincode_raw, city_raw)
-                if existing_addr:
+                cached_addr = batch_addresses.get(addr_key) or address_cache.get(addr_key)
+                existing_addr = None if cached_addr else find_existing_address(db, addr_line_raw, phone_digits, pincode_raw, city_raw)
+                if cached_addr:
+                    address_id, resolved_state_id = cached_addr
+                    logger.debug("Reused cached address %s for order %s", address_id, wix_order_id)
+                elif existing_addr:
                     address_id = existing_addr.get("address_id")
                     resolved_state_id = existing_addr.get("state_id") or None
                     logger.debug("Reused address %s for order %s", address_id, wix_order_id)
                 else:
-                    resolved_state_id = find_state_id(db, contact.get("region"))
+                    resolved_state_id = find_state_id(db, contact.get("region"), state_map)
                     addr_payload = {
-                        "name": sanitize_scalar(name or "Wix Customer"),
-                        "mobile": sanitize_scalar(phone_digits or ""),
-                        "pincode": sanitize_scalar(pincode_raw or ""),
+                        "name": name or "Wix Customer",
+                        "mobile": phone_digits or "",
+                        "pincode": pincode_raw,
                         "locality": "",
-                        "address_line": sanitize_scalar(addr_line_raw or ""),
-                        "city": sanitize_scalar(city_raw or ""),
+                        "address_line": addr_line_raw,
+                        "city": city_raw,
                         "state_id": resolved_state_id or 1,
                         "address_type": "shipping",
                         "created_at": created_at,
@@ -869,36 +1460,24 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
                         addr_payload["customer_id"] = customer_id
                     elif offline_customer_id:
                         addr_payload["offline_customer_id"] = offline_customer_id
-                    address_id = create_address(db, addr_payload)
+                    address_id = create_address(db, addr_payload, now=created_at)
+                    # We just inserted it, so the stored state_id is known without re-reading
+                    resolved_state_id = addr_payload["state_id"]
                     logger.debug("Created address %s for order %s", address_id, wix_order_id)
             except Exception as e:
                 logger.exception("address handling failed for %s: %s", wix_order_id, e)
                 order_result["reasons"].append(f"address_handling_failed:{e}")
 
-            if address_id and not resolved_state_id:
-                try:
-                    rr = db.execute(text("SELECT state_id FROM address WHERE address_id = :aid LIMIT 1"), {"aid": address_id}).first()
-                    if rr and rr[0]:
-                        resolved_state_id = int(rr[0])
-                except Exception:
-                    pass
-
             # ----------------------
             #   LINE ITEMS + INVOICE LOGIC
             # ----------------------
             line_items = w.get("lineItems") or w.get("items") or []
             items_out = []
 
-            # If force and existing order -> delete order_items for recreation
-            if existing_order and force:
-                try:
-                    db.execute(text("DELETE FROM order_items WHERE order_id = :oid"), {"oid": wix_order_id})
-                    logger.debug("Deleted previous order_items for %s (force)", wix_order_id)
-                except Exception as e:
-                    logger.exception("Failed delete order_items for %s: %s", wix_order_id, e)
-
             # FIX 1: Log full line_items payload for debugging SKU/product lookup failures
-            logger.debug("Order %s has %d line_items: %s", wix_order_id, len(line_items), json.dumps(line_items, default=str)[:2000])
+            # (json.dumps is eager, so only pay for it when DEBUG records are actually emitted)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Order %s has %d line_items: %s", wix_order_id, len(line_items), json.dumps(line_items, default=str)[:2000])
 
             # Step 1: gather base unit prices and product mapping
             for li in line_items:
@@ -907,26 +1486,10 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
                         logger.warning("Order %s: skipping non-dict line item: %s", wix_order_id, li)
                         continue
 
-                    # FIX 1: Broaden SKU extraction - check all common Wix SKU fields
-                    phys = li.get("physicalProperties") or {}
-                    sku_raw = (
-                        phys.get("sku")
-                        or li.get("sku")
-                        or li.get("variantSku")
-                        or li.get("skuId")
-                        or (li.get("catalogReference") or {}).get("catalogItemId")
-                        or ""
-                    )
-                    sku = safe_str(sku_raw).strip()
-
-                    wix_pid = safe_str(
-                        (li.get("catalogReference") or {}).get("catalogItemId")
-                        if isinstance(li.get("catalogReference"), dict)
-                        else li.get("productId") or li.get("product_id") or ""
-                    )
+                    sku = _line_item_sku(li)
 
-                    name_field = li.get("productName") or li.get("name") or li.get("title") or ""
-                    title = safe_str(name_field.get("original") if isinstance(name_field, dict) else name_field)
+                    wix_pid = _line_item_wix_pid(li)
+                    title = _line_item_title(li)
 
                     qty = int(li.get("quantity") or li.get("qty") or 1)
                     base_price = extract_price_value(li)
@@ -936,41 +1499,13 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
                         wix_order_id, sku, wix_pid, title, qty, base_price
                     )
 
-                    product = None
-                    mapping = None
-
-                    # Try SKU first
-                    if is_valid_sku(sku):
-                        product = find_product_by_sku(db, sku)
-                        if product:
-                            mapping = f"sku:{sku}"
-                        else:
-                            logger.debug("Order %s: SKU %r not found in products table", wix_order_id, sku)
-
-                    # Try wix product id
-                    if not product and wix_pid:
-                        product = find_product_by_wix_pid(db, wix_pid)
-                        if product:
-                            mapping = f"wixpid:{wix_pid}"
-                        else:
-                            logger.debug("Order %s: wix_pid %r not found in products table", wix_order_id, wix_pid)
-
-                    # Try product name
-                    if not product and title:
-                        product = find_product_by_name(db, title)
-                        if product:
-                            mapping = f"name:{title}"
-                        else:
-                            logger.debug("Order %s: title %r not found in products table", wix_order_id, title)
+                    product, mapping = _resolve_product(db, product_cache, sku, wix_pid, title)
 
                     # Enforce misc product fallback if still unknown
                     if not product:
-                        misc_row = db.execute(
-                            text("SELECT product_id, name, sku_id, IFNULL(zoho_sku,'') AS zoho_sku FROM products WHERE sku_id = 'misc' LIMIT 1")
-                        ).first()
-                        if not misc_row:
+                        product = _misc_product(db, product_cache)
+                        if not product:
                             raise HTTPException(500, "Misc product (sku='misc') not found. Please create it in products table.")
-                        product = dict(misc_row._mapping)
                         mapping = "misc_assigned"
                         logger.warning(
                             "Order %s: no product match for sku=%r wix_pid=%r title=%r — assigned misc (product_id=%s)",
@@ -1026,8 +1561,8 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
             payment_status_raw = safe_str(payment_status_raw).upper()
 
             gateway_status = (
-                ((billing.get("paymentGateway") or {}).get("transactionStatus"))
-                or ((billing.get("paymentGatewayInfo") or {}).get("status"))
+                _dig(billing, "paymentGateway", "transactionStatus")
+                or _dig(billing, "paymentGatewayInfo", "status")
                 or ""
             )
             gateway_status = safe_str(gateway_status).upper()
@@ -1041,9 +1576,9 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
             is_paid = False
             if paid_amount > 0:
                 is_paid = True
-            elif payment_status_raw in ["PAID", "ACCEPTED", "SUCCESS"]:
+            elif payment_status_raw in _PAID_STATUSES:
                 is_paid = True
-            elif gateway_status in ["SUCCESS", "PAID", "CAPTURED"]:
+            elif gateway_status in _GATEWAY_PAID_STATUSES:
                 is_paid = True
 
             payment_status = "paid" if is_paid else "pending"
@@ -1058,7 +1593,12 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
             except Exception:
                 subtotal_val = subtotal_sum
 
-            order_index = get_next_order_index(db)
+            # order_index: one MAX() per batch, then a local counter
+            order_index = None
+            if not existing_order:
+                if next_order_index is None:
+                    next_order_index = get_next_order_index(db)
+                order_index = next_order_index
 
             order_payload = {
                 "order_id": wix_order_id,
@@ -1086,241 +1626,706 @@ def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
                 "order_status": "PENDING",
             }
 
-            # STEP A: Insert/update the orders row and commit BEFORE inserting order_items.
-            # order_items has a FK on orders.order_id — the parent must exist first.
-            try:
-                if not existing_order:
-                    db.execute(text("""
-                        INSERT INTO orders
-                        (order_id, customer_id, offline_customer_id, address_id,
-                         total_items, subtotal, total_amount, channel, payment_status,
-                         delivery_status, created_at, updated_at, order_index, payment_type, gst, upload_wbn,
-                         discount_percent, delivery_charge, tax_percent, fulfillment_status,
-                         delivery_method, order_status)
-                        VALUES
-                        (:order_id, :customer_id, :offline_customer_id, :address_id,
-                         :total_items, :subtotal, :total_amount, :channel, :payment_status,
-                         :delivery_status, :created_at, :updated_at, :order_index, :payment_type, :gst, :upload_wbn,
-                         :discount_percent, :delivery_charge, :tax_percent, :fulfillment_status,
-                         :delivery_method, :order_status)
-                    """), order_payload)
-                else:
-                    db.execute(text("""
-                        UPDATE orders SET
-                          total_items = :total_items,
-                          subtotal = :subtotal,
-                          total_amount = :total_amount,
-                          payment_status = :payment_status,
-                          updated_at = :updated_at,
-                          discount_percent = :discount_percent,
-                          delivery_charge = :delivery_charge,
-                          tax_percent = :tax_percent,
-                          fulfillment_status = :fulfillment_status,
-                          delivery_method = :delivery_method,
-                          order_status = :order_status
-                        WHERE order_id = :order_id
-                    """), {
-                        "total_items": order_payload["total_items"],
-                        "subtotal": round(order_payload["subtotal"], 2),
-                        "total_amount": float(order_payload["total_amount"]),
-                        "payment_status": order_payload["payment_status"],
-                        "updated_at": order_payload["updated_at"],
-                        "order_id": order_payload["order_id"],
-                        "discount_percent": 0.0,
-                        "delivery_charge": delivery_charge,
-                        "tax_percent": 18.00,
-                        "fulfillment_status": 0,
-                        "delivery_method": "standard",
-                        "order_status": "PENDING",
-                    })
-                # Commit the orders row so the FK is satisfied before inserting order_items
-                db.commit()
-                logger.debug("Committed orders row for %s", wix_order_id)
-            except Exception as e:
-                try:
-                    db.rollback()
-                except Exception:
-                    logger.exception("Rollback failed for order %s", wix_order_id)
-                skipped += 1
-                order_result["status"] = "skipped"
-                order_result["reasons"].append(f"order_insert_failed:{e}")
-                logger.exception("Order insert/update failed for %s: %s", wix_order_id, e)
-                details.append(order_result)
-                continue
-
-            # STEP B: Now insert order_items (parent orders row is committed above)
-            for item in items_out:
-                try:
-                    result = db.execute(text("""
-                        INSERT INTO order_items (order_id, product_id, model_id, color_id,
-                                                 quantity, unit_price, total_price)
-                        VALUES (:oid, :pid, NULL, NULL, :qty, :unit, :total)
-                    """), {
-                        "oid": wix_order_id,
-                        "pid": item["product_id"],
-                        "qty": item["quantity"],
-                        "unit": item["unit_price"],
-                        "total": item["total_price"],
-                    })
-                    item_id = result.lastrowid
-
-                    # 🔴 LEGACY REQUIRED INSERT
-                    insert_order_details(
-                        db=db,
-                        order_id=wix_order_id,
-                        item_id=item_id,
-                        product_id=item["product_id"]
-                    )
-                except Exception as e:
-                    logger.exception("order_item insert failed for order %s item %s: %s", wix_order_id, item.get("title"), e)
-                    order_result["reasons"].append(f"order_item_insert_failed:{e}")
-
-            try:
-                db.commit()
-                _notify_orders_table_changed(
-                    wix_order_id,
-                    "created" if not existing_order else "updated",
-                )
-                if not existing_order:
-                    _notify_order_created_sync(
-                        phone=str(phone_digits or ""),
-                        order_id=wix_order_id,
-                        customer_name=name or "",
-                        amount=f"₹{payment_due:,.0f}",
-                        address_line=addr_line_raw,
-                        payment_status=payment_status,
-                    )
-            except Exception as e:
-                try:
-                    db.rollback()
-                except Exception:
-                    logger.exception("Rollback failed after order_items commit for %s", wix_order_id)
-                order_result["reasons"].append(f"order_items_commit_failed:{e}")
-                logger.exception("order_items commit failed for %s: %s", wix_order_id, e)
-
+            # The orders row is written inside the order's savepoint, so a failing row also
+            # undoes this order's customer/address writes. Its items are written after the loop.
             if not existing_order:
-                inserted += 1
-                order_result["status"] = "inserted"
+                next_order_index = _insert_order_row(db, order_payload) + 1
             else:
-                order_result["status"] = "updated"
+                db.execute(_UPDATE_ORDER, {
+                    "total_items": order_payload["total_items"],
+                    "subtotal": round(order_payload["subtotal"], 2),
+                    "total_amount": float(order_payload["total_amount"]),
+                    "payment_status": order_payload["payment_status"],
+                    "updated_at": order_payload["updated_at"],
+                    "order_id": order_payload["order_id"],
+                    "discount_percent": 0.0,
+                    "delivery_charge": delivery_charge,
+                    "tax_percent": 18.00,
+                    "fulfillment_status": 0,
+                    "delivery_method": "standard",
+                    "order_status": "PENDING",
+                })
+            savepoint.commit()
+            if address_id:
+                batch_addresses[addr_key] = (address_id, resolved_state_id)
+            if customer_id:
+                remember_customer(batch_customers, customer_id, name, phone_digits, email)
+
+            notification = {"order_id": wix_order_id, "action": "created" if not existing_order else "updated"}
+            if not existing_order:
+                notification["whatsapp"] = {
+                    "phone": str(phone_digits or ""),
+                    "order_id": wix_order_id,
+                    "customer_name": name or "",
+                    "amount": f"₹{payment_due:,.0f}",
+                    "address_line": addr_line_raw,
+                    "payment_status": payment_status,
+                }
+            staged.append({
+                "order_id": wix_order_id,
+                "existing": existing_order,
+                "items": items_out,
+                "result": order_result,
+                "notification": notification,
+            })
+
+            order_result["status"] = "updated" if existing_order else "inserted"
             order_result["items"] = items_out
             order_result["customer_id"] = customer_id
             order_result["offline_customer_id"] = offline_customer_id
             order_result["address_id"] = address_id
-            logger.info("Processed order %s (items=%d)", wix_order_id, len(items_out))
 
             details.append(order_result)
 
+        except (SQLAlchemyError, HTTPException) as e:
+            # expected failures (DB errors, missing misc product) log one line
+            logger.error("Failed to process order %s: %s", w.get("id"), e)
+            _rollback_order_savepoint(savepoint)
+            skipped += 1
+            details.append({"wix_order_id": w.get("id") or "", "status": "skipped", "reasons": [str(e)], "items": []})
+            continue
         except Exception as e:
-            logger.exception("Unexpected error processing order: %s", e)
-            try:
-                db.rollback()
-            except Exception:
-                logger.exception("Rollback after unexpected error failed.")
+            logger.exception("Unexpected error processing order %s: %s", w.get("id"), e)
+            _rollback_order_savepoint(savepoint)
             skipped += 1
-            details.append({"wix_order_id": safe_str(w.get("id")), "status": "skipped", "reasons": [str(e)], "items": []})
+            details.append({"wix_order_id": w.get("id") or "", "status": "skipped", "reasons": [str(e)], "items": []})
             continue
 
-    logger.info("Wix sync done: inserted=%d skipped=%d", inserted, skipped)
-    return {"message": "Wix sync completed", "inserted": inserted, "skipped": skipped, "details": details}
+    # STEP A: the orders rows were written in the loop (order_items has a FK on
+    # orders.order_id, so the parent rows must exist first); collect the item rows.
+    pending_notifications: List[Dict] = []
+    try:
+        item_rows: List[Dict] = []
+        for entry in staged:
+            for item in entry["items"]:
+                item_rows.append({
+                    "oid": entry["order_id"],
+                    "pid": item["product_id"],
+                    "qty": item["quantity"],
+                    "unit": item["unit_price"],
+                    "total": item["total_price"],
+                })
+
+        # If force -> replace the order_items of the existing orders that were updated:
+        # one DELETE for the batch, in the same transaction as the re-insert below.
+        recreate_ids = [entry["order_id"] for entry in staged if entry["existing"]]
+        if recreate_ids:
+            db.execute(_DELETE_ORDER_ITEMS_FOR_ORDERS, {"ids": recreate_ids})
+            logger.debug("Deleted previous order_items for %d orders (force)", len(recreate_ids))
+
+        # STEP B: Now insert order_items for the whole batch (one multi-row INSERT),
+        # then the legacy order_details mirror rows with one INSERT ... SELECT.
+        failed_items = _execute_many_isolated(db, _INSERT_ORDER_ITEM, item_rows, "oid")
+        # 🔴 LEGACY REQUIRED INSERT
+        insert_order_details_for_orders(db, [entry["order_id"] for entry in staged if entry["items"]])
+
+        for entry in staged:
+            wix_order_id = entry["order_id"]
+            if wix_order_id in failed_items:
+                logger.error("order_item insert failed for order %s: %s", wix_order_id, failed_items[wix_order_id])
+                entry["result"]["reasons"].append(f"order_item_insert_failed:{failed_items[wix_order_id]}")
+            if not entry["existing"]:
+                inserted += 1
+            pending_notifications.append(entry["notification"])
+            logger.info("Processed order %s (items=%d)", wix_order_id, len(entry["items"]))
+
+        # Single commit for the batch
+        db.commit()
+        address_cache.update(batch_addresses)
+        customer_cache.update(batch_customers.maps[0])
+    except Exception as e:
+        logger.exception("Wix sync commit failed: %s", e)
+        try:
+            db.rollback()
+        except Exception:
+            logger.exception("Rollback after failed sync commit failed.")
+        inserted = 0
+        for entry in staged:
+            order_result = entry["result"]
+            if order_result["status"] != "skipped":
+                skipped += 1
+                order_result["status"] = "skipped"
+                order_result["reasons"].append(f"commit_failed:{e}")
+        pending_notifications = []
+
+    # Notify only once the orders are visible to other sessions
+    for notification in pending_notifications:
+        _notify_orders_table_changed(notification["order_id"], notification["action"])
+        if notification.get("whatsapp"):
+            _notify_order_created_sync(**notification["whatsapp"])
+
+    return inserted, skipped, details
+
+# ---------------------------
+# Main sync endpoint (final optimized)
+# ---------------------------
+# Held for the whole of a sync run; every entry point (GET /wix, background jobs and the
+# auto-sync timer) goes through _run_wix_sync, so at most one run writes orders at a time.
+_SYNC_RUN_LOCK = threading.Lock()
+
+def _run_wix_sync(db: Session, force: bool, max_pages: int,
+                  progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Run a Wix sync unless another one is already in progress in this process,
+    in which case an "already_running" result is returned without touching the DB.
+    """
+    if not _SYNC_RUN_LOCK.acquire(blocking=False):
+        logger.info("Wix sync already running, not starting another")
+        return {
+            "status": "already_running", "message": "A Wix sync is already running",
+            "inserted": 0, "skipped": 0, "details": [],
+        }
+    try:
+        return _sync_wix_orders_locked(db, force, max_pages, progress)
+    finally:
+        _SYNC_RUN_LOCK.release()
+
+def _sync_wix_orders_locked(db: Session, force: bool, max_pages: int,
+                            progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Core of the Wix sync: stream orders and write/commit them in batches of SYNC_BATCH_SIZE.
+    `progress`, when given, is called with the running counts after every batch (used by background jobs).
+    Callers must hold _SYNC_RUN_LOCK.
+    """
+    # Indexed address lookups are used when the address_hash migration has been applied
+    detect_address_hash_column(db)
+
+    # Per-request lookup tables: states are tiny and read-only; addresses, products and
+    # customers resolved earlier in this sync are reused by later orders without querying again.
+    try:
+        state_map = load_state_map(db)
+    except Exception as e:
+        logger.warning("Could not preload state table, falling back to per-order lookups: %s", e)
+        state_map = None
+    address_cache: Dict[tuple, tuple] = {}
+    product_cache: Dict[tuple, Optional[Dict]] = {}
+    customer_cache: Dict[tuple, Optional[Dict]] = {}
+    counters: Dict[str, Optional[int]] = {"synthetic_mobile": None}
+
+    inserted = 0
+    skipped = 0
+    fetched = 0
+    details: List[Dict] = []
+
+    for batch in _batched(iter_wix_orders(max_pages=max_pages), SYNC_BATCH_SIZE):
+        fetched += len(batch)
+        b_inserted, b_skipped, b_details = _sync_wix_batch(
+            db, batch, force, state_map, address_cache, product_cache, counters, customer_cache
+        )
+        inserted += b_inserted
+        skipped += b_skipped
+        details.extend(b_details)
+        if progress is not None:
+            progress({"fetched": fetched, "inserted": inserted, "skipped": skipped})
+
+    logger.info("Wix sync done: fetched=%d inserted=%d skipped=%d", fetched, inserted, skipped)
+    return {
+        "status": "completed", "message": "Wix sync completed",
+        "inserted": inserted, "skipped": skipped, "details": details,
+    }
+
+# ---------------------------
+# Background sync jobs (in-process, polled via /sync/wix/jobs/{job_id})
+# ---------------------------
+_SYNC_JOBS: Dict[str, Dict] = {}
+_SYNC_JOBS_LOCK = threading.Lock()  # guards _SYNC_JOBS and every job dict in it
+_SYNC_JOBS_KEEP = 20  # finished jobs kept for polling
+_SYNC_JOBS_TTL_SECONDS = 3600  # finished jobs older than this are dropped
+
+def _update_sync_job(job_id: str, fields: Dict):
+    with _SYNC_JOBS_LOCK:
+        _SYNC_JOBS[job_id].update(fields)
+
+def _prune_sync_jobs():
+    """Drop finished jobs past the TTL, then all but the newest _SYNC_JOBS_KEEP. Caller holds the lock."""
+    now = datetime.utcnow()
+    finished = [jid for jid, job in _SYNC_JOBS.items() if job["finished_at"] is not None]
+    for jid in finished:
+        age = now - datetime.fromisoformat(_SYNC_JOBS[jid]["finished_at"])
+        if age.total_seconds() > _SYNC_JOBS_TTL_SECONDS:
+            _SYNC_JOBS.pop(jid)
+    finished = [jid for jid in finished if jid in _SYNC_JOBS]
+    for jid in finished[:max(0, len(finished) - _SYNC_JOBS_KEEP)]:
+        _SYNC_JOBS.pop(jid)
+
+def _run_sync_job(job_id: str, force: bool, max_pages: int):
+    _update_sync_job(job_id, {"status": "running"})
+    db = SessionLocal()
+    fields: Dict[str, Any] = {}
+    try:
+        result = _run_wix_sync(db, force, max_pages, progress=lambda counts: _update_sync_job(job_id, counts))
+        if result["status"] == "already_running":
+            fields = {"status": "already_running", "error": result["message"]}
+        else:
+            fields = {"status": "done", "details": result["details"]}
+    except HTTPException as e:
+        fields = {"status": "failed", "error": e.detail}
+    except Exception as e:
+        logger.exception("Background Wix sync %s failed: %s", job_id, e)
+        fields = {"status": "failed", "error": str(e)}
+    finally:
+        fields["finished_at"] = datetime.utcnow().isoformat()
+        _update_sync_job(job_id, fields)
+        db.close()
+
+def _start_sync_job(force: bool, max_pages: int) -> Dict:
+    """
+    Queue a sync on a daemon thread; an already running job is returned instead of
+    starting another. Returns a snapshot of the job.
+    """
+    with _SYNC_JOBS_LOCK:
+        for job in _SYNC_JOBS.values():
+            if job["status"] in ("queued", "running"):
+                return dict(job)
+        _prune_sync_jobs()
+        job_id = uuid.uuid4().hex
+        # every key exists from the start; the worker only changes values
+        job = {
+            "job_id": job_id, "status": "queued", "force": force, "pages": max_pages,
+            "fetched": 0, "inserted": 0, "skipped": 0, "details": None, "error": None,
+            "started_at": datetime.utcnow().isoformat(), "finished_at": None,
+        }
+        _SYNC_JOBS[job_id] = job
+        snapshot = dict(job)
+    threading.Thread(target=_run_sync_job, args=(job_id, force, max_pages), daemon=True).start()
+    return snapshot
+
+@router.get("/wix")
+def sync_wix_orders(request: Request, db: Session = Depends(get_db)):
+    """
+    Sync Wix orders. Use ?force=1 to force reprocessing (recreate order_items).
+    Use ?pages=N to walk N pages of 100 orders (default 1, the most recent page).
+    Orders are streamed from Wix and written/committed in batches of SYNC_BATCH_SIZE.
+    Use ?background=1 to return immediately with a job_id; poll /sync/wix/jobs/{job_id}.
+    Only one sync runs at a time; while one is in progress this returns status "already_running".
+    """
+    force = request.query_params.get("force") == "1"
+    try:
+        max_pages = max(1, int(request.query_params.get("pages") or 1))
+    except (TypeError, ValueError):
+        max_pages = 1
+
+    if not WIX_CREDENTIALS_OK:
+        logger.error("Missing Wix credentials")
+        raise HTTPException(status_code=500, detail="Missing Wix credentials")
+
+    if request.query_params.get("background") == "1":
+        job = _start_sync_job(force, max_pages)
+        return {"status": job["status"], "job_id": job["job_id"]}
+
+    return _run_wix_sync(db, force, max_pages)
+
+@router.get("/wix/jobs/{job_id}")
+def get_sync_job(job_id: str):
+    with _SYNC_JOBS_LOCK:
+        _prune_sync_jobs()
+        job = _SYNC_JOBS.get(job_id)
+        snapshot = dict(job) if job else None
+    if not snapshot:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return snapshot
 
 # ---------------------------
 # Recover endpoint
 # ---------------------------
+def iter_response_orders(res):
+    """
+    Yield the `orders` array of a Wix query response one order at a time.
+    With ijson installed (and the request made with stream=True) the body is parsed
+    incrementally, so the whole page is never held as one dict graph; otherwise
+    falls back to decoding the whole body.
+    """
+    try:
+        import ijson
+    except ImportError:
+        yield from (_json_body(res).get("orders", []) or [])
+        return
+    res.raw.decode_content = True
+    yield from ijson.items(res.raw, "orders.item", use_float=True)
+
+WIX_FETCH_CONCURRENCY = 8
+
+def fetch_all_wix_orders(page_size: int = WIX_PAGE_SIZE, concurrency: int = WIX_FETCH_CONCURRENCY,
+                         on_page: Optional[Callable[[List[Dict]], None]] = None) -> List[Dict]:
+    """
+    Fetch every Wix order using offset paging. The first page is fetched on its own to
+    learn totalResults; the remaining pages are then requested concurrently, in windows
+    of `concurrency` pages, until the total is reached or a short page comes back.
+
+    With `on_page`, each page (minus orders already seen) is handed to the callback as
+    soon as its window arrives and is not kept, so memory stays at one window of pages;
+    the return value is then empty. Without it, all orders are returned as one list.
+    """
+    orders: List[Dict] = []
+
+    def _emit(page: List[Dict]):
+        if on_page is not None:
+            on_page(page)
+        else:
+            orders.extend(page)
+
+    res = _query_wix_page(0, page_size)
+    if res.status_code != 200:
+        raise HTTPException(status_code=500, detail=f"Wix error: {res.text}")
+    data = _json_body(res)
+    first = list(data.get("orders", []) or [])
+    _emit(first)
+    if len(first) < page_size:
+        return orders
+
+    total = data.get("totalResults")
+    seen = {o.get("id") for o in first}
+
+    async def _drain():
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(timeout=30, limits=limits) as client:
+            async def _page(offset: int) -> List[Dict]:
+                r = await client.post(
+                    WIX_ORDERS_QUERY_URL,
+                    headers=_WIX_HEADERS,
+                    json=_wix_query_page_body(offset, page_size),
+                )
+                if r.status_code != 200:
+                    raise HTTPException(status_code=500, detail=f"Wix error: {r.text}")
+                return _json_body(r).get("orders", []) or []
+
+            offset = page_size
+            while total is None or offset < int(total):
+                offsets = [offset + i * page_size for i in range(concurrency)]
+                if total is not None:
+                    offsets = [off for off in offsets if off < int(total)]
+                pages = await asyncio.gather(*(_page(off) for off in offsets))
+                added = 0
+                for page in pages:
+                    fresh = [o for o in page if o.get("id") not in seen]
+                    seen.update(o.get("id") for o in fresh)
+                    added += len(fresh)
+                    _emit(fresh)
+                # stop on the last (short) page, or if paging made no progress
+                if not added or any(len(p) < page_size for p in pages):
+                    return
+                offset = offsets[-1] + page_size
+
+    asyncio.run(_drain())
+    return orders
+
 @router.get("/wix/recover")
 def recover_missing_orders(db: Session = Depends(get_db)):
-    if not WIX_API_KEY or not WIX_SITE_ID:
+    if not WIX_CREDENTIALS_OK:
         raise HTTPException(status_code=500, detail="Missing Wix credentials")
-    all_orders = []
-    cursor = None
-    while True:
-        body = {"paging": {"limit": 100}}
-        if cursor:
-            body["paging"]["cursor"] = cursor
-        res = requests.post(
-            "https://www.wixapis.com/stores/v2/orders/query",
-            headers={"Authorization": WIX_API_KEY, "wix-site-id": WIX_SITE_ID, "Content-Type": "application/json"},
-            json=body, timeout=30
-        )
-        if res.status_code != 200:
-            raise HTTPException(status_code=500, detail=f"Wix error: {res.text}")
-        data = res.json()
-        all_orders.extend(data.get("orders", []) or [])
-        cursor = data.get("paging", {}).get("cursors", {}).get("next")
-        if not cursor:
-            break
-    db_orders = {str(r[0]) for r in db.execute(text("SELECT order_id FROM orders")).fetchall()}
-    missing = []
-    for o in all_orders:
-        oid = str(o.get("id") or "")
-        num = str(o.get("number") or "")
-        if (oid not in db_orders) and (num not in db_orders):
-            missing.append(o)
-    return {"total_wix_orders": len(all_orders), "orders_in_db": len(db_orders), "missing_count": len(missing), "missing_order_ids": [o.get("id") for o in missing][:50]}
+    total_wix_orders = 0
+    missing_count = 0
+    missing_ids: List[Any] = []
+
+    def _check_page(page: List[Dict]):
+        # Each page is checked as it arrives and then dropped; only missing ids are kept.
+        # Only the ids Wix gave us are looked up instead of loading every order_id in the table.
+        nonlocal total_wix_orders, missing_count
+        total_wix_orders += len(page)
+        wanted = {str(o.get("id") or "") for o in page} | {str(o.get("number") or "") for o in page}
+        found = find_existing_order_ids(db, [w for w in wanted if w])
+        for o in page:
+            keys = {str(o.get("id") or ""), str(o.get("number") or "")}
+            keys = {k for k in keys if k}
+            if not any(k in found or f"WIX#{k}" in found for k in keys):
+                missing_count += 1
+                if len(missing_ids) < 50:
+                    missing_ids.append(o.get("id"))
+
+    fetch_all_wix_orders(on_page=_check_page)
+    orders_in_db = db.execute(text("SELECT COUNT(*) FROM orders")).scalar() or 0
+    return {"total_wix_orders": total_wix_orders, "orders_in_db": orders_in_db, "missing_count": missing_count, "missing_order_ids": missing_ids}
 
 # ---------------------------
 # Reconcile endpoint
 # ---------------------------
+_RECONCILE_FIX_FIELDS = ("payment_status", "subtotal", "total_amount")
+RECONCILE_COMMIT_EVERY = 50  # orders with fixes per transaction (and per UPDATE)
+
+@functools.lru_cache(maxsize=16)
+def _order_fixes_stmt(n: int):
+    """
+    UPDATE for `n` orders, built once per flush size:
+      SET subtotal = CASE order_id WHEN :oid0 THEN COALESCE(:subtotal0, subtotal) ... ELSE subtotal END, ...
+    A NULL value leaves that field of that order unchanged.
+    """
+    set_clauses = []
+    for field in _RECONCILE_FIX_FIELDS:
+        whens = " ".join(f"WHEN :oid{i} THEN COALESCE(:{field}{i}, {field})" for i in range(n))
+        set_clauses.append(f"{field} = CASE order_id {whens} ELSE {field} END")
+    in_list = ", ".join(f":oid{i}" for i in range(n))
+    return text(f"UPDATE orders SET {', '.join(set_clauses)}, updated_at = :now WHERE order_id IN ({in_list})")
+
+def _apply_order_fixes(db: Session, pending_fixes: Dict[str, Dict[str, Any]], now: datetime):
+    """
+    Write the reconcile fixes with one CASE-WHEN UPDATE (WHERE order_id IN (...)).
+    A flush holds at most RECONCILE_COMMIT_EVERY orders. Caller commits.
+    """
+    params: Dict[str, Any] = {"now": now}
+    for i, (oid, fields) in enumerate(pending_fixes.items()):
+        params[f"oid{i}"] = oid
+        for field in _RECONCILE_FIX_FIELDS:
+            params[f"{field}{i}"] = fields.get(field)
+    db.execute(_order_fixes_stmt(len(pending_fixes)), params)
+
+RECONCILE_WINDOW = 100  # Wix orders whose DB rows are read with one IN query
+
+# only the columns reconcile compares
+_RECONCILE_ORDER_ROWS = text("""
+    SELECT order_id, payment_status, subtotal, total_amount
+    FROM orders WHERE order_id IN :oids
+""").bindparams(bindparam("oids", expanding=True))
+
+def _reconcile_order_id(w: Dict, fetched_number: Any = None) -> str:
+    # Prefer number, fallback to id; always prefixed with WIX#
+    return f"WIX#{safe_str(w.get('number') or fetched_number or w.get('id')).strip()}"
+
+# helper: determine wix payment_status using same rules as sync
+def detect_wix_paid_status(w: Dict) -> str:
+    totals = w.get("totals") or {}
+    billing = w.get("billingInfo") or {}
+    payment_status_raw = (
+        (totals.get("paymentStatus") or "")
+        or (billing.get("paymentStatus") or "")
+        or (w.get("paymentStatus") or "")
+    ).upper()
+    gateway_status = (
+        _dig(billing, "paymentGateway", "transactionStatus")
+        or _dig(billing, "paymentGatewayInfo", "status")
+        or ""
+    ).upper()
+    try:
+        paid_amount = float(totals.get("paid") or 0)
+    except Exception:
+        paid_amount = 0.0
+    is_paid = False
+    if paid_amount > 0:
+        is_paid = True
+    elif payment_status_raw in _PAID_STATUSES:
+        is_paid = True
+    elif gateway_status in _GATEWAY_PAID_STATUSES:
+        is_paid = True
+    return "paid" if is_paid else "pending"
+
+# helper: compute wix subtotal & due (same rules used in sync)
+def wix_amounts(w: Dict, subtotal_sum: float = 0.0):
+    totals = w.get("totals") or {}
+    payment_due = totals.get("paymentDue") or totals.get("total") or subtotal_sum
+    try:
+        subtotal_val = float(totals.get("subtotal") or subtotal_sum)
+    except Exception:
+        subtotal_val = subtotal_sum
+    try:
+        payment_due = float(payment_due)
+    except Exception:
+        payment_due = subtotal_sum
+    return subtotal_val, payment_due
+
+def _cents(x) -> int:
+    """Money as integer paise, so comparisons are exact integer equality."""
+    return int(round(float(x or 0) * 100))
+
+def _reconcile_compare(w: Dict, db_rows: Dict[str, Any], fixes: bool, fetched_number: Any = None):
+    """
+    Compare one Wix order with its prefetched DB row (`db_rows`, keyed by order_id).
+    `fetched_number` is the order number prefetched for orders whose payload lacks one.
+    Returns (order_report, order_fixes) where order_fixes is {field: wix value}.
+    """
+    order_report = {"wix_id": w.get("id"), "wix_number": w.get("number"), "db_order_id": None, "differences": [], "fixed": []}
+    order_fixes: Dict[str, Any] = {}
+    try:
+        wix_order_id = _reconcile_order_id(w, fetched_number)
+        order_report["wix_order_id"] = wix_order_id
+
+        o = db_rows.get(wix_order_id)
+        if o is None:
+            # not present in DB -> record and continue
+            order_report["differences"].append({"type": "missing_in_db"})
+            return order_report, order_fixes
+
+        order_report["db_order_id"] = o.order_id
+
+        # --- compute wix totals & payment
+        # compute subtotal_sum from line items for robust comparison
+        line_items = w.get("lineItems") or w.get("items") or []
+        wix_subtotal_sum = 0.0
+        for li in line_items:
+            wix_price = 0.0
+            try:
+                wix_price = extract_price_value(li)
+            except Exception:
+                wix_price = 0.0
+            wix_qty = int(li.get("quantity") or li.get("qty") or 1)
+            wix_subtotal_sum += round(wix_price * wix_qty, 2)
+
+        wix_subtotal_val, wix_payment_due = wix_amounts(w, subtotal_sum=wix_subtotal_sum)
+        wix_payment_status = detect_wix_paid_status(w)
+
+        # Fast path: most orders match — one tuple compare instead of three field checks
+        db_payment_status = (o.payment_status or "").lower()
+        db_sub = float(o.subtotal or 0)
+        db_total = float(o.total_amount or 0)
+        db_sub_c, db_total_c = _cents(db_sub), _cents(db_total)
+        wix_sub_c, wix_due_c = _cents(wix_subtotal_val), _cents(wix_payment_due)
+        if (db_payment_status, db_sub_c, db_total_c) == (wix_payment_status, wix_sub_c, wix_due_c):
+            return order_report, order_fixes
+
+        # --- 1) payment_status
+        if db_payment_status != wix_payment_status:
+            order_report["differences"].append({
+                "field": "payment_status",
+                "db": db_payment_status,
+                "wix": wix_payment_status
+            })
+            if fixes:
+                order_fixes["payment_status"] = wix_payment_status
+
+        # --- 2) subtotal
+        if db_sub_c != wix_sub_c:
+            order_report["differences"].append({"field": "subtotal", "db": db_sub,"wix": wix_subtotal_val})
+            if fixes:
+                order_fixes["subtotal"] = wix_subtotal_val
+
+        # --- 3) total_amount
+        if db_total_c != wix_due_c:
+            order_report["differences"].append({
+                "field": "total_amount",
+                "db": db_total,
+                "wix": wix_payment_due
+            })
+            if fixes:
+                order_fixes["total_amount"] = wix_payment_due
+
+    except (SQLAlchemyError, HTTPException) as e:
+        order_report["differences"].append({"error": str(e)})
+        logger.error("Error during reconcile for order %s: %s", w.get("id"), e)
+    except Exception as e:
+        order_report["differences"].append({"error": str(e)})
+        logger.exception("Error during reconcile for order %s: %s", w.get("id"), e)
+
+    return order_report, order_fixes
+
+def _dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, default=str).decode()
+    return json.dumps(obj, default=str)
+
+def _iter_reconcile(db: Session, wix_orders, fixes: bool, diff_only: bool):
+    """
+    Run the reconcile over `wix_orders` and yield ("report", order_report) for every
+    checked order (only those with differences when `diff_only`), in input order,
+    once its fixes (if any) have been written.
+    The last item is ("checked", (orders checked, orders with differences)).
+    """
+    now = datetime.utcnow()  # one updated_at for every fix written by this run
+    checked_orders = 0
+    with_differences = 0
+    # order_id -> {field: wix value}; written in one UPDATE per flush
+    pending_fixes: Dict[str, Dict[str, Any]] = {}
+    fix_reports: Dict[str, Dict] = {}
+    # reports held back until the fixes before them are committed
+    held: List[Dict] = []
+
+    def _flush_fixes():
+        # apply the accumulated fixes in one transaction. The bulk UPDATE runs in a
+        # SAVEPOINT; if it fails, each order is retried in its own SAVEPOINT so one bad
+        # row only fails that order.
+        if not pending_fixes:
+            return
+        failed: Dict[str, str] = {}
+        try:
+            sp = db.begin_nested()
+            try:
+                _apply_order_fixes(db, pending_fixes, now)
+                sp.commit()
+            except Exception as e:
+                sp.rollback()
+                logger.warning("Wix reconcile: bulk fix failed, retrying per order: %s", e)
+                for oid in pending_fixes:
+                    sp = db.begin_nested()
+                    try:
+                        _apply_order_fixes(db, {oid: pending_fixes[oid]}, now)
+                        sp.commit()
+                    except Exception as row_e:
+                        sp.rollback()
+                        failed[oid] = str(row_e)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.exception("Wix reconcile: applying fixes failed: %s", e)
+            failed = {oid: str(e) for oid in pending_fixes}
+
+        for oid, fields in pending_fixes.items():
+            if oid in failed:
+                fix_reports[oid]["differences"].append({"fix_failed": f"{', '.join(fields)} update failed: {failed[oid]}"})
+            else:
+                for field, value in fields.items():
+                    fix_reports[oid]["fixed"].append({"field": field, "to": value})
+        pending_fixes.clear()
+        fix_reports.clear()
+
+    # compare in windows: per window, missing order numbers are fetched concurrently
+    # and the DB rows for all of its orders are read with one IN query
+    for window in _batched(wix_orders, RECONCILE_WINDOW):
+        numbers = fetch_wix_order_numbers([w.get("id") for w in window if not w.get("number")])
+        oids = [_reconcile_order_id(w, numbers.get(w.get("id"))) for w in window]
+        try:
+            # Row objects are used as-is (attribute access), no per-row dict copy
+            db_rows = {r.order_id: r for r in db.execute(_RECONCILE_ORDER_ROWS, {"oids": oids})}
+        except SQLAlchemyError as e:
+            logger.error("Wix reconcile: loading %d orders failed: %s", len(oids), e)
+            db.rollback()
+            db_rows = None
+        for w, oid in zip(window, oids):
+            if db_rows is None:
+                order_report = {"wix_id": w.get("id"), "wix_number": w.get("number"), "wix_order_id": oid,
+                                "db_order_id": None, "differences": [{"error": "db_lookup_failed"}], "fixed": []}
+                order_fixes = {}
+            else:
+                order_report, order_fixes = _reconcile_compare(w, db_rows, fixes, numbers.get(w.get("id")))
+            checked_orders += 1
+            if order_report["differences"]:
+                with_differences += 1
+                held.append(order_report)
+            elif not diff_only:
+                held.append(order_report)
+            if order_fixes:
+                oid = order_report["db_order_id"]
+                pending_fixes[oid] = order_fixes
+                fix_reports[oid] = order_report
+                if len(pending_fixes) >= RECONCILE_COMMIT_EVERY:
+                    _flush_fixes()
+            if not pending_fixes:
+                for r in held:
+                    yield "report", r
+                held.clear()
+
+    # apply the remaining fixes
+    _flush_fixes()
+    for r in held:
+        yield "report", r
+    yield "checked", (checked_orders, with_differences)
+
 @router.get("/wix/reconcile")
-def reconcile_wix_orders(fix: Optional[int] = 0, limit: Optional[int] = 200, db: Session = Depends(get_db)):
+def reconcile_wix_orders(fix: Optional[int] = 0, limit: Optional[int] = 200, diff_only: Optional[int] = 0,
+                         stream: Optional[int] = 0, db: Session = Depends(get_db)):
     """
     Reconcile Wix orders with local DB.
     Query params:
       - fix=1  -> attempt to auto-fix detected mismatches
       - limit  -> how many Wix orders to fetch/process per run (default 200)
-    Returns a JSON list of orders with detected differences and what was fixed.
+      - diff_only=1 -> leave orders that matched (no differences) out of the report
+      - stream=1 -> NDJSON: one order report per line as it completes, then a summary line
+    Returns a JSON report for every checked order: detected differences and what was fixed.
+    DB rows are read RECONCILE_WINDOW orders at a time with one IN query; fixes are
+    written from the same session.
     """
-    if not WIX_API_KEY or not WIX_SITE_ID:
+    if not WIX_CREDENTIALS_OK:
         raise HTTPException(status_code=500, detail="Missing Wix credentials")
 
-    # helper: determine wix payment_status using same rules as sync
-    def detect_wix_paid_status(w: Dict) -> str:
-        totals = w.get("totals") or {}
-        billing = w.get("billingInfo") or {}
-        payment_status_raw = (
-            (totals.get("paymentStatus") or "")
-            or (billing.get("paymentStatus") or "")
-            or (w.get("paymentStatus") or "")
-        ).upper()
-        gateway_status = (
-            ((billing.get("paymentGateway") or {}).get("transactionStatus") or "")
-            or ((billing.get("paymentGatewayInfo") or {}).get("status") or "")
-        ).upper()
-        try:
-            paid_amount = float(totals.get("paid") or 0)
-        except Exception:
-            paid_amount = 0.0
-        is_paid = False
-        if paid_amount > 0:
-            is_paid = True
-        elif payment_status_raw in ["PAID", "ACCEPTED", "SUCCESS"]:
-            is_paid = True
-        elif gateway_status in ["SUCCESS", "PAID", "CAPTURED"]:
-            is_paid = True
-        return "paid" if is_paid else "pending"
-
-    # helper: compute wix subtotal & due (same rules used in sync)
-    def wix_amounts(w: Dict, subtotal_sum: float = 0.0):
-        totals = w.get("totals") or {}
-        payment_due = totals.get("paymentDue") or totals.get("total") or subtotal_sum
-        try:
-            subtotal_val = float(totals.get("subtotal") or subtotal_sum)
-        except Exception:
-            subtotal_val = subtotal_sum
-        try:
-            payment_due = float(payment_due)
-        except Exception:
-            payment_due = subtotal_sum
-        return subtotal_val, payment_due
-
     # fetch wix orders (single page)
     try:
-        res = requests.post(
-            "https://www.wixapis.com/stores/v2/orders/query",
-            headers={"Authorization": WIX_API_KEY, "wix-site-id": WIX_SITE_ID, "Content-Type": "application/json"},
-            json={"paging": {"limit": limit}},
-            timeout=30
-        )
+        res = _query_wix_page(0, limit, stream=True)
     except Exception as e:
         logger.exception("Wix reconcile: API call error: %s", e)
         raise HTTPException(status_code=500, detail=f"Wix API error: {e}")
@@ -1329,118 +2334,54 @@ def reconcile_wix_orders(fix: Optional[int] = 0, limit: Optional[int] = 200, db:
         logger.error("Wix reconcile: non-200 response: %s - %s", res.status_code, res.text[:300])
         raise HTTPException(status_code=500, detail=f"Wix responded: {res.status_code}")
 
-    data = res.json()
-    wix_orders = data.get("orders", []) or []
-
-    report = []
+    # orders are parsed one at a time off the response stream
+    wix_orders = iter_response_orders(res)
     fixes = bool(int(fix))
 
-    for w in wix_orders:
-        order_report = {"wix_id": w.get("id"), "wix_number": w.get("number"), "db_order_id": None, "differences": [], "fixed": []}
-        try:
-            # Prefer number, fallback to id
-            wix_number = w.get("number") or fetch_wix_order_number(w.get("id")) or w.get("id")
-            raw_id = safe_str(wix_number).strip()
-
-            # Always prefix with WIX#
-            wix_order_id = f"WIX#{raw_id}"
-            order_report["wix_order_id"] = wix_order_id
-
-            # load DB order by order_id (match either number or UUID/id)
-            db_order_row = db.execute(text("SELECT * FROM orders WHERE order_id = :oid LIMIT 1"), {"oid": wix_order_id}).first()
-            if not db_order_row:
-                # not present in DB -> record and continue
-                order_report["differences"].append({"type": "missing_in_db"})
-                report.append(order_report)
-                continue
-
-            o = dict(db_order_row._mapping)
-            order_report["db_order_id"] = o.get("order_id")
-
-            # --- compute wix totals & payment
-            # compute subtotal_sum from line items for robust comparison
-            line_items = w.get("lineItems") or w.get("items") or []
-            wix_subtotal_sum = 0.0
-            for li in line_items:
-                wix_price = 0.0
-                try:
-                    wix_price = extract_price_value(li)
-                except Exception:
-                    wix_price = 0.0
-                wix_qty = int(li.get("quantity") or li.get("qty") or 1)
-                wix_subtotal_sum += round(wix_price * wix_qty, 2)
-
-            wix_subtotal_val, wix_payment_due = wix_amounts(w, subtotal_sum=wix_subtotal_sum)
-            wix_payment_status = detect_wix_paid_status(w)
-
-            # --- 1) payment_status
-            db_payment_status = (o.get("payment_status") or "").lower()
-            if db_payment_status != wix_payment_status:
-                order_report["differences"].append({
-                    "field": "payment_status",
-                    "db": db_payment_status,
-                    "wix": wix_payment_status
-                })
-                if fixes:
-                    try:
-                        db.execute(text("UPDATE orders SET payment_status = :ps, updated_at = :u WHERE order_id = :oid"),
-                                   {"ps": wix_payment_status, "u": datetime.utcnow(), "oid": o.get("order_id")})
-                        db.commit()
-                        order_report["fixed"].append({"field": "payment_status", "to": wix_payment_status})
-                    except Exception as e:
-                        db.rollback()
-                        order_report["differences"].append({"fix_failed": f"payment_status update failed: {e}"})
-
-            # --- 2) subtotal
-            db_sub = float(o.get("subtotal") or 0)
-            if round(db_sub, 2) != round(wix_subtotal_val, 2):
-                order_report["differences"].append({"field": "subtotal", "db": db_sub,"wix": wix_subtotal_val})
-                if fixes:
-                    try:
-                        db.execute(text("UPDATE orders SET subtotal = :st, updated_at = :u WHERE order_id = :oid"),
-                                   {"st": wix_subtotal_val, "u": datetime.utcnow(), "oid": o.get("order_id")})
-                        db.commit()
-                        order_report["fixed"].append({"field": "subtotal", "to": wix_subtotal_val})
-                    except Exception as e:
-                        db.rollback()
-                        order_report["differences"].append({"fix_failed": f"subtotal update failed: {e}"})
-
-            # --- 3) total_amount
-            db_total = float(o.get("total_amount") or 0)
-            if round(db_total, 2) != round(wix_payment_due, 2):
-                order_report["differences"].append({
-                    "field": "total_amount",
-                    "db": db_total,
-                    "wix": wix_payment_due
-                })
-                if fixes:
-                    try:
-                        db.execute(text("""
-                            UPDATE orders
-                            SET total_amount = :ta, updated_at = :u
-                            WHERE order_id = :oid
-                        """), {
-                            "ta": wix_payment_due,
-                            "u": datetime.utcnow(),
-                            "oid": o.get("order_id")
-                        })
-                        db.commit()
-                        order_report["fixed"].append({"field": "total_amount", "to": wix_payment_due})
-                    except Exception as e:
-                        db.rollback()
-                        order_report["differences"].append({"fix_failed": f"total_amount update failed: {e}"})
-
-            # done for this order
-            report.append(order_report)
+    if stream:
+        def _ndjson():
+            # the request session is closed once the handler returns, so the stream owns one
+            stream_db = SessionLocal()
+            try:
+                checked_orders = with_differences = 0
+                for kind, item in _iter_reconcile(stream_db, wix_orders, fixes, bool(diff_only)):
+                    if kind == "report":
+                        yield _dumps(item) + "\n"
+                    else:
+                        checked_orders, with_differences = item
+                yield _dumps({
+                    "message": "Wix reconciliation complete",
+                    "fix_mode": fixes,
+                    "checked_orders": checked_orders,
+                    "with_differences": with_differences,
+                }) + "\n"
+            finally:
+                stream_db.close()
+                res.close()
+
+        return StreamingResponse(_ndjson(), media_type="application/x-ndjson")
 
-        except Exception as e:
-            order_report["differences"].append({"error": str(e)})
-            report.append(order_report)
-            logger.exception("Error during reconcile for order %s: %s", w.get("id"), e)
+    report = []
+    append = report.append
+    checked_orders = with_differences = 0
+    try:
+        for kind, item in _iter_reconcile(db, wix_orders, fixes, bool(diff_only)):
+            if kind == "report":
+                append(item)
+            else:
+                checked_orders, with_differences = item
+    finally:
+        # hand the streamed connection back to the _WIX pool
+        res.close()
 
-    return {
+    payload = {
         "message": "Wix reconciliation complete",
         "fix_mode": fixes,
-        "checked_orders": len(wix_orders),
+        "checked_orders": checked_orders,
+        "with_differences": with_differences,
         "report": report
     }
+    if orjson is not None:
+        # serialize once with orjson instead of FastAPI's jsonable_encoder + json.dumps
+        return Response(orjson.dumps(payload, default=str), media_type="application/json")
+    return payload
@@ -0,0 +1,27 @@
+"""
+Shared setup for the backend tests.
+
+Run from backend/:
+    pip install -r requirements-dev.txt
+    python -m pytest
+
+The modules under test import the app's runtime dependencies (FastAPI, SQLAlchemy,
+PyMySQL, httpx, ...). When those are not installed, the tests that need them are
+skipped with the missing package named in the reason.
+"""
+import importlib
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_WIX_SYNC_DEPS = ("fastapi", "sqlalchemy", "pymysql", "httpx", "requests", "dotenv")
+
+
+@pytest.fixture
+def wix_sync():
+    for mod in _WIX_SYNC_DEPS:
+        pytest.importorskip(mod)
+    return importlib.import_module("routes.wix_sync")
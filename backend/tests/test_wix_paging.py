@@ -0,0 +1,52 @@
+import json
+
+
+class _FakeResponse:
+    status_code = 200
+    text = ""
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+    @property
+    def content(self):
+        return json.dumps(self._payload).encode()
+
+
+def _fake_wix(pages, calls):
+    def post(url, json=None, timeout=None, **kwargs):
+        calls.append(json)
+        offset = json["query"]["paging"]["offset"]
+        return _FakeResponse(pages[offset])
+    return post
+
+
+def test_iter_wix_orders_pages_by_offset(wix_sync, monkeypatch):
+    pages = {
+        0: {"orders": [{"id": "a"}, {"id": "b"}], "totalResults": 3},
+        2: {"orders": [{"id": "c"}], "totalResults": 3},
+    }
+    calls = []
+    monkeypatch.setattr(wix_sync._WIX, "post", _fake_wix(pages, calls))
+
+    orders = list(wix_sync.iter_wix_orders(max_pages=None, page_size=2))
+
+    assert [o["id"] for o in orders] == ["a", "b", "c"]
+    assert [c["query"]["paging"]["offset"] for c in calls] == [0, 2]
+
+
+def test_iter_wix_orders_respects_max_pages(wix_sync, monkeypatch):
+    pages = {
+        0: {"orders": [{"id": "a"}, {"id": "b"}], "totalResults": 4},
+        2: {"orders": [{"id": "c"}, {"id": "d"}], "totalResults": 4},
+    }
+    calls = []
+    monkeypatch.setattr(wix_sync._WIX, "post", _fake_wix(pages, calls))
+
+    orders = list(wix_sync.iter_wix_orders(max_pages=1, page_size=2))
+
+    assert [o["id"] for o in orders] == ["a", "b"]
+    assert len(calls) == 1
@@ -0,0 +1,48 @@
+import pytest
+
+
+def test_run_wix_sync_refuses_second_run(wix_sync):
+    with wix_sync._SYNC_RUN_LOCK:
+        result = wix_sync._run_wix_sync(db=None, force=False, max_pages=1)
+
+    assert result["status"] == "already_running"
+    assert result["inserted"] == 0 and result["details"] == []
+
+
+def test_run_wix_sync_releases_lock_on_error(wix_sync, monkeypatch):
+    def boom(*args, **kwargs):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(wix_sync, "_sync_wix_orders_locked", boom)
+
+    with pytest.raises(RuntimeError):
+        wix_sync._run_wix_sync(db=None, force=False, max_pages=1)
+
+    assert not wix_sync._SYNC_RUN_LOCK.locked()
+
+
+def test_get_sync_job_returns_a_snapshot(wix_sync, monkeypatch):
+    job = {"job_id": "j1", "status": "running", "details": None, "error": None, "finished_at": None}
+    monkeypatch.setattr(wix_sync, "_SYNC_JOBS", {"j1": job})
+
+    snapshot = wix_sync.get_sync_job("j1")
+    job["status"] = "done"
+
+    assert snapshot["status"] == "running"
+    assert snapshot is not job
+
+
+def test_finished_jobs_are_pruned(wix_sync, monkeypatch):
+    from datetime import datetime, timedelta
+
+    stale = (datetime.utcnow() - timedelta(seconds=wix_sync._SYNC_JOBS_TTL_SECONDS + 60)).isoformat()
+    jobs = {
+        "stale": {"finished_at": stale},
+        "running": {"finished_at": None},
+    }
+    monkeypatch.setattr(wix_sync, "_SYNC_JOBS", jobs)
+
+    with wix_sync._SYNC_JOBS_LOCK:
+        wix_sync._prune_sync_jobs()
+
+    assert list(jobs) == ["running"]